@@ -1,12 +1,17 @@
+from __future__ import absolute_import
 from piston.handler import BaseHandler
 from piston.utils import rc
-from libcloud.common.types import InvalidCredsException
 
 from overmind.provisioning.provider_meta import PROVIDERS
 from overmind.provisioning.models import Provider, Image, Location, Size, Node
+from overmind.provisioning.models import SyncLease, SyncRun
 from overmind.provisioning.models import get_state
 from overmind.provisioning.views import save_new_node, save_new_provider, update_provider
-import copy, logging
+# Same module path as the worker so the task names match
+from provisioning import tasks
+from provisioning.ratelimit import RateLimitExceeded
+from celery.result import AsyncResult
+import copy, datetime, logging
 
 # Unit tests are not working for HttpBasicAuthentication
 # This is a hack until authentication is reimplemented as OAuth
@@ -147,6 +152,40 @@ class ImageHandler(BaseHandler):
                 return rc.NOT_FOUND
 
 
+class SyncLeaseHandler(BaseHandler):
+    fields = ('kind', 'owner', 'expires_at')
+    model = SyncLease
+    allowed_methods = ('GET',)
+    
+    def read(self, request, *args, **kwargs):
+        return self.model.objects.filter(provider=kwargs.get('provider_id'))
+
+
+class SyncRunHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    def read(self, request, *args, **kwargs):
+        '''Returns sync run statistics per provider and kind
+        for the last ?hours (default 24), optionally for one ?kind
+        '''
+        try:
+            hours = float(request.GET.get('hours', 24))
+            # Also rejects nan
+            if not 0 < hours < float('inf'):
+                raise ValueError
+            since = datetime.datetime.now() - datetime.timedelta(hours=hours)
+        except (ValueError, OverflowError):
+            resp = rc.BAD_REQUEST
+            resp.write("\nhours must be a positive number")
+            return resp
+        runs = SyncRun.objects.filter(started_at__gte=since)
+        if kwargs.get('provider_id'):
+            runs = runs.filter(provider=kwargs['provider_id'])
+        if request.GET.get('kind'):
+            runs = runs.filter(kind=request.GET['kind'])
+        return SyncRun.stats(runs)
+
+
 class LocationHandler(BaseHandler):
     fields = ('id', 'location_id', 'name')
     model = Location
@@ -209,8 +248,12 @@ class NodeHandler(BaseHandler):
             provider_id = request.GET.get('provider_id')
             if provider_id is not None:
                 query = query.filter(provider=provider_id)
+            # Filter by extra data, e.g. ?extra.product=EQ%208
+            for key, value in request.GET.items():
+                if key.startswith('extra.'):
+                    query = query.filter(extra__key=key[6:], extra__value=value)
             if request.GET.get('show_decommissioned') != 'true':
-                query = query.exclude(environment='Decommissioned')
+                query = query.filter(environment__in=Node.ACTIVE_ENVIRONMENTS)
             return query
         else:
             # Return the selected node
@@ -255,6 +298,10 @@ class NodeHandler(BaseHandler):
             node = self.model.objects.get(id=id)
             if node.environment == 'Decommissioned':
                 return rc.NOT_HERE
+            if node.pending:
+                resp = rc.BAD_REQUEST
+                resp.write("\nThe node is still being created")
+                return resp
             if node.provider.supports('destroy'):
                 node.destroy(request.user.username)
             else:
@@ -262,3 +309,86 @@ class NodeHandler(BaseHandler):
             return rc.DELETED
         except self.model.DoesNotExist:
             return rc.NOT_FOUND
+        except RateLimitExceeded, e:
+            resp = rc.THROTTLED
+            resp.write("\n%s" % e)
+            return resp
+
+
+class NodeStatusHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    def read(self, request, *args, **kwargs):
+        '''Returns the creation status of a node'''
+        try:
+            node = Node.objects.get(id=kwargs.get('id'))
+        except Node.DoesNotExist:
+            return rc.NOT_FOUND
+        return {
+            'id': node.id,
+            'node_id': node.node_id,
+            'state': node.state,
+            'environment': node.environment,
+            'error': node.extra_data().get('error') \
+                if isinstance(node.extra_data(), dict) else None,
+        }
+
+
+class NodeActionHandler(BaseHandler):
+    allowed_methods = ('POST',)
+    
+    def create(self, request, *args, **kwargs):
+        '''Reboots or destroys a list of nodes (node_ids, a JSON list or
+        repeated form fields) or all the nodes of a provider (provider_id).
+        Returns the id of the job doing it'''
+        if not hasattr(request, "data"):
+            request.data = request.POST
+        attrs = self.flatten_dict(request.data)
+        action = attrs.get('action')
+        perms = {
+            'reboot': 'provisioning.change_node',
+            'destroy': 'provisioning.delete_node',
+        }
+        if action not in perms:
+            resp = rc.BAD_REQUEST
+            resp.write("\naction: must be reboot or destroy")
+            return resp
+        if not _TESTING and not request.user.has_perm(perms[action]):
+            return rc.FORBIDDEN
+        
+        node_ids = attrs.get('node_ids')
+        if hasattr(request.data, 'getlist') and 'node_ids' in request.data:
+            # Form encoded, node_ids=1&node_ids=2
+            node_ids = request.data.getlist('node_ids')
+        provider_id = attrs.get('provider_id')
+        if node_ids is None and provider_id is not None:
+            node_ids = list(Node.objects.filter(
+                provider=provider_id, environment__in=Node.ACTIVE_ENVIRONMENTS
+            ).values_list('id', flat=True))
+        if not isinstance(node_ids, list):
+            resp = rc.BAD_REQUEST
+            resp.write("\nnode_ids or provider_id is required")
+            return resp
+        for i, node_id in enumerate(node_ids):
+            try:
+                node_ids[i] = int(node_id)
+            except (TypeError, ValueError):
+                resp = rc.BAD_REQUEST
+                resp.write("\nnode_ids: invalid node id %r" % (node_id,))
+                return resp
+        
+        result = tasks.node_action.delay(
+            action, node_ids, request.user.username)
+        return {'job_id': result.task_id}
+
+
+class JobHandler(BaseHandler):
+    allowed_methods = ('GET',)
+    
+    def read(self, request, *args, **kwargs):
+        result = AsyncResult(kwargs.get('job_id'))
+        return {
+            'job_id': result.task_id,
+            'state': result.state,
+            'results': result.result if result.successful() else None,
+        }
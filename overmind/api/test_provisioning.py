@@ -1,11 +1,14 @@
 import copy
+import datetime
 import unittest
 import json
 
 from django.test import TestCase
 from django.test.client import Client
 from django.contrib.auth.models import User, Group
-from overmind.provisioning.models import Provider, Node
+from overmind.provisioning.models import Provider, Node, SyncLease, SyncRun
+from overmind.provisioning.models import Image, Location, Size
+from provisioning import tasks
 
 
 class BaseProviderTestCase(TestCase):
@@ -340,6 +343,173 @@ class ReadImageTest(BaseProviderTestCase):
         self.assertEquals(json.loads(response.content), expected)
 
 
+class ReadSyncLeaseTest(BaseProviderTestCase):
+    def test_get_leases(self):
+        '''Should show the syncs running for a provider'''
+        p1 = Provider(name="prov1", provider_type="DUMMY", access_key="keyzz")
+        p1.save()
+        SyncLease.acquire(p1, 'nodes', 'someworker')
+        response = self.client.get(self.path + str(p1.id) + "/leases/")
+        self.assertEquals(response.status_code, 200)
+        leases = json.loads(response.content)
+        self.assertEquals(len(leases), 1)
+        self.assertEquals(leases[0]['kind'], 'nodes')
+        self.assertEquals(leases[0]['owner'], 'someworker')
+
+
+class ReadSyncRunTest(BaseProviderTestCase):
+    def test_get_sync_stats(self):
+        '''Should return sync percentiles for the requested window'''
+        p1 = Provider(name="prov1", provider_type="DUMMY", access_key="keyzz")
+        p1.save()
+        now = datetime.datetime.now()
+        for duration in [1.0, 2.0, 3.0, 4.0]:
+            SyncRun.record(p1, 'nodes', now, duration, 0.5, {'created': 1})
+        SyncRun.record(p1, 'nodes', now - datetime.timedelta(hours=48), 99, 0)
+        response = self.client.get(self.path + str(p1.id) + "/syncs/")
+        self.assertEquals(response.status_code, 200)
+        stats = json.loads(response.content)
+        self.assertEquals(len(stats), 1)
+        self.assertEquals(stats[0]['kind'], 'nodes')
+        self.assertEquals(stats[0]['runs'], 4)
+        self.assertEquals(stats[0]['created'], 4)
+        self.assertEquals(stats[0]['duration'],
+            {'p50': 2.0, 'p90': 4.0, 'p99': 4.0, 'max': 4.0})
+
+        response = self.client.get("/api/syncs/?hours=72")
+        self.assertEquals(json.loads(response.content)[0]['runs'], 5)
+
+    def test_invalid_hours(self):
+        '''Should return BAD_REQUEST for hours that aren't a positive number'''
+        for hours in ['abc', 'nan', 'inf', '1e300', '-1', '0']:
+            response = self.client.get("/api/syncs/?hours=" + hours)
+            self.assertEquals(response.status_code, 400)
+
+
+class ReadNodeTest(BaseProviderTestCase):
+    def setUp(self):
+        super(ReadNodeTest, self).setUp()
+        self.path = "/api/nodes/"
+
+        self.p1 = Provider(name="prov1", provider_type="DUMMY", access_key="2")
+        self.p1.save()
+        self.p1.import_nodes()
+
+    def test_get_nodes_by_extra_data(self):
+        '''Should filter nodes by their extra data'''
+        response = self.client.get(self.path + "?extra.foo=bar")
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(json.loads(response.content)), 2)
+
+        response = self.client.get(self.path + "?extra.foo=baz")
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.content), [])
+
+
+class CreateNodeTest(BaseProviderTestCase):
+    def setUp(self):
+        super(CreateNodeTest, self).setUp()
+        self.path = "/api/nodes/"
+
+        self.p1 = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        self.p1.save()
+        self.p1.import_nodes()
+        for kind in ['images', 'locations', 'sizes']:
+            getattr(self.p1, 'import_' + kind)()
+        self.image = Image.objects.filter(provider=self.p1)[0]
+        self.image.favorite = True
+        self.image.save()
+        self.data = {
+            'provider_id': self.p1.id,
+            'image': self.image.id,
+            'location': Location.objects.filter(provider=self.p1)[0].id,
+            'size': Size.objects.filter(provider=self.p1)[0].id,
+        }
+
+    def test_create_node(self):
+        '''Should return the new node at once and create it in the background'''
+        data = dict(self.data, name='newnode')
+        resp = self.client.post(
+            self.path, json.dumps(data), content_type='application/json')
+        self.assertEquals(resp.status_code, 200)
+        node = json.loads(resp.content)
+        self.assertEquals(node['name'], 'newnode')
+
+        # Tasks run eagerly in tests, so the node is already created
+        resp = self.client.get(self.path + str(node['id']) + "/status")
+        self.assertEquals(resp.status_code, 200)
+        status = json.loads(resp.content)
+        self.assertEquals(status['state'], 'Running')
+        self.assertEquals(status['error'], None)
+        self.assertFalse(status['node_id'].startswith('pending-'))
+
+    def test_create_node_duplicate_name(self):
+        '''Should not create a node with the name of an existing one'''
+        data = dict(self.data, name='dummy-0')
+        resp = self.client.post(
+            self.path, json.dumps(data), content_type='application/json')
+        self.assertEquals(resp.status_code, 400)
+
+
+class NodeActionTest(BaseProviderTestCase):
+    def setUp(self):
+        super(NodeActionTest, self).setUp()
+        self.path = "/api/nodes/actions/"
+
+        self.p1 = Provider(name="prov1", provider_type="DUMMY", access_key="3")
+        self.p1.save()
+        self.p1.import_nodes()
+
+    def test_reboot_nodes(self):
+        '''Should return a job id when rebooting a list of nodes'''
+        ids = list(Node.objects.values_list('id', flat=True))
+        data = {'action': 'reboot', 'node_ids': ids}
+        resp = self.client.post(
+            self.path, json.dumps(data), content_type='application/json')
+        self.assertEquals(resp.status_code, 200)
+        self.assertTrue('job_id' in json.loads(resp.content))
+
+    def test_form_encoded_node_ids(self):
+        '''Should accept node_ids as repeated form fields'''
+        ids = list(Node.objects.values_list('id', flat=True))
+        resp = self.client.post(self.path, {'action': 'reboot', 'node_ids': ids})
+        self.assertEquals(resp.status_code, 200)
+        self.assertTrue('job_id' in json.loads(resp.content))
+
+    def test_invalid_node_id(self):
+        '''Should return BAD_REQUEST for node ids that aren't integers'''
+        data = {'action': 'reboot', 'node_ids': [1, 'abc']}
+        resp = self.client.post(
+            self.path, json.dumps(data), content_type='application/json')
+        self.assertEquals(resp.status_code, 400)
+        self.assertTrue('abc' in resp.content)
+
+    def test_invalid_action(self):
+        '''Should return BAD_REQUEST for unknown actions'''
+        data = {'action': 'explode', 'provider_id': self.p1.id}
+        resp = self.client.post(
+            self.path, json.dumps(data), content_type='application/json')
+        self.assertEquals(resp.status_code, 400)
+
+    def test_read_job(self):
+        '''Should return the state and the results per node of a job'''
+        ids = list(Node.objects.values_list('id', flat=True))
+        # Eager tasks don't store their result, store it like a worker
+        results = tasks.node_action('reboot', ids, 'testuser')
+        tasks.node_action.backend.mark_as_done('job-1', results)
+        resp = self.client.get("/api/jobs/job-1")
+        self.assertEquals(resp.status_code, 200)
+        job = json.loads(resp.content)
+        self.assertEquals(job['state'], 'SUCCESS')
+        self.assertEquals(sorted(job['results'].keys()),
+            sorted([str(i) for i in ids]))
+        self.assertEquals(job['results'][str(ids[0])],
+            {'result': True, 'error': None})
+
+        resp = self.client.get("/api/jobs/job-2")
+        self.assertEquals(json.loads(resp.content)['state'], 'PENDING')
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(CreateProviderTest))
@@ -347,4 +517,9 @@ def suite():
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(UpdateProviderTest))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(DeleteProviderTest))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ReadImageTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ReadSyncLeaseTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ReadSyncRunTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ReadNodeTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(CreateNodeTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(NodeActionTest))
     return suite
@@ -1,5 +1,7 @@
 from django.conf.urls.defaults import *
 from api.provisioning import ProviderHandler, NodeHandler, ImageHandler
+from api.provisioning import SyncLeaseHandler, NodeActionHandler, JobHandler
+from api.provisioning import NodeStatusHandler, SyncRunHandler
 import api
 from urls import CsrfExemptResource
 
@@ -9,13 +11,24 @@ api.provisioning._TESTING = True
 
 provider_resource = CsrfExemptResource(ProviderHandler)
 image_resource = CsrfExemptResource(ImageHandler)
+lease_resource = CsrfExemptResource(SyncLeaseHandler)
+sync_run_resource = CsrfExemptResource(SyncRunHandler)
 node_resource = CsrfExemptResource(NodeHandler)
+node_action_resource = CsrfExemptResource(NodeActionHandler)
+job_resource = CsrfExemptResource(JobHandler)
+node_status_resource = CsrfExemptResource(NodeStatusHandler)
 
 urlpatterns = patterns('',
     url(r'^providers/(?P<provider_id>\d+)/images/$', image_resource),
     url(r'^providers/(?P<provider_id>\d+)/images/(?P<id>\d+)$', image_resource),
+    url(r'^providers/(?P<provider_id>\d+)/leases/$', lease_resource),
+    url(r'^providers/(?P<provider_id>\d+)/syncs/$', sync_run_resource),
+    url(r'^syncs/$', sync_run_resource),
     url(r'^providers/$', provider_resource),
     url(r'^providers/(?P<id>\d+)$', provider_resource),
     url(r'^nodes/$', node_resource),
     url(r'^nodes/(?P<id>\d+)$', node_resource),
+    url(r'^nodes/(?P<id>\d+)/status$', node_status_resource),
+    url(r'^nodes/actions/$', node_action_resource),
+    url(r'^jobs/(?P<job_id>[\w-]+)$', job_resource),
 )
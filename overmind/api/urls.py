@@ -3,6 +3,8 @@ from piston.resource import Resource
 from piston.authentication import HttpBasicAuthentication
 
 from api.provisioning import ProviderHandler, NodeHandler, ImageHandler
+from api.provisioning import SyncLeaseHandler, NodeActionHandler, JobHandler
+from api.provisioning import NodeStatusHandler, SyncRunHandler
 
 
 auth = HttpBasicAuthentication(realm="overmind")
@@ -16,13 +18,24 @@ class CsrfExemptResource(Resource):
 
 provider_resource = CsrfExemptResource(ProviderHandler, **ad)
 image_resource = CsrfExemptResource(ImageHandler, **ad)
+lease_resource = CsrfExemptResource(SyncLeaseHandler, **ad)
+sync_run_resource = CsrfExemptResource(SyncRunHandler, **ad)
 node_resource = CsrfExemptResource(NodeHandler, **ad)
+node_action_resource = CsrfExemptResource(NodeActionHandler, **ad)
+job_resource = CsrfExemptResource(JobHandler, **ad)
+node_status_resource = CsrfExemptResource(NodeStatusHandler, **ad)
 
 urlpatterns = patterns('',
     url(r'^providers/(?P<provider_id>\d+)/images/$', image_resource),
     url(r'^providers/(?P<provider_id>\d+)/images/(?P<id>\d+)$', image_resource),
+    url(r'^providers/(?P<provider_id>\d+)/leases/$', lease_resource),
+    url(r'^providers/(?P<provider_id>\d+)/syncs/$', sync_run_resource),
+    url(r'^syncs/$', sync_run_resource),
     url(r'^providers/$', provider_resource),
     url(r'^providers/(?P<id>\d+)$', provider_resource),
     url(r'^nodes/$', node_resource),
     url(r'^nodes/(?P<id>\d+)$', node_resource),
+    url(r'^nodes/(?P<id>\d+)/status$', node_status_resource),
+    url(r'^nodes/actions/$', node_action_resource),
+    url(r'^jobs/(?P<job_id>[\w-]+)$', job_resource),
 )
@@ -77,3 +77,47 @@ function ajaxSubmit(form, redirect) {
         });
     }
 }
+
+function nodeTooltips(container) {
+    // Shows the details of a node when hovering its name. They are fetched
+    // from /node/<id>/detail/ the first time, with one handler for all nodes
+    var details = {};
+    var current = null;
+    var tooltip = $('<div id="tooltip"></div>').hide().appendTo('body');
+
+    function render(data) {
+        var table = $('<table></table>');
+        $.each(data.fields, function(i, field) {
+            $('<tr></tr>')
+                .append($('<td></td>').text(field[0] + ':'))
+                .append($('<td></td>').text(field[1]))
+                .appendTo(table);
+        });
+        return table;
+    }
+
+    function show(id) {
+        if (current === id && details[id]) {
+            tooltip.empty().append(details[id]).show();
+        }
+    }
+
+    container.delegate('span.name', 'mouseenter', function(e) {
+        var id = $(this).attr('data-node');
+        current = id;
+        tooltip.css({ left: e.pageX + 15, top: e.pageY + 15 });
+        if (details[id]) {
+            show(id);
+        } else {
+            $.getJSON('/node/' + id + '/detail/', function(data) {
+                details[id] = render(data);
+                show(id);
+            });
+        }
+    }).delegate('span.name', 'mousemove', function(e) {
+        tooltip.css({ left: e.pageX + 15, top: e.pageY + 15 });
+    }).delegate('span.name', 'mouseleave', function() {
+        current = null;
+        tooltip.hide();
+    });
+}
@@ -0,0 +1,116 @@
+# Bulk write helpers
+# Django 1.3 has no QuerySet.bulk_create(), so rows are written with a single
+# executemany() per call instead of one INSERT/UPDATE per model instance
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+
+def _columns(model, fields=None):
+    '''Returns the concrete fields that should be written for model'''
+    cols = []
+    for f in model._meta.local_fields:
+        if isinstance(f, AutoField):
+            continue
+        if fields is not None and f.name not in fields and f.attname not in fields:
+            continue
+        cols.append(f)
+    return cols
+
+
+def bulk_insert(model, objs):
+    '''Inserts all objs with one query. Primary keys are not set on objs'''
+    if not objs: return 0
+    qn = connection.ops.quote_name
+    fields = _columns(model)
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join([qn(f.column) for f in fields]),
+        ", ".join(["%s"] * len(fields)),
+    )
+    rows = []
+    for obj in objs:
+        rows.append([f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+            for f in fields])
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+    return len(rows)
+
+
+def bulk_update(model, objs, fields):
+    '''Writes the given fields of all (already saved) objs with one query'''
+    if not objs: return 0
+    qn = connection.ops.quote_name
+    fields = _columns(model, fields)
+    pk = model._meta.pk
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+        qn(model._meta.db_table),
+        ", ".join(["%s = %%s" % qn(f.column) for f in fields]),
+        qn(pk.column),
+    )
+    rows = []
+    for obj in objs:
+        row = [f.get_db_prep_save(f.pre_save(obj, False), connection=connection)
+            for f in fields]
+        row.append(obj.pk)
+        rows.append(row)
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+    return len(rows)
+
+
+# Rows written per INSERT/UPDATE batch. Each batch is committed on its own
+# unless the caller manages the transaction
+CHUNK_SIZE = 500
+
+
+def chunks(objs, size=CHUNK_SIZE):
+    for i in xrange(0, len(objs), size):
+        yield objs[i:i + size]
+
+
+def bulk_delete(model, pks, chunk_size=CHUNK_SIZE):
+    '''Deletes the rows with the given primary keys, one query per chunk'''
+    for chunk in chunks(list(pks), chunk_size):
+        model.objects.filter(pk__in=chunk).delete()
+
+
+def upsert_catalog(model, provider, key, rows, chunk_size=CHUNK_SIZE):
+    '''Syncs a provider catalog (images, sizes, locations) with the DB
+    rows is a list of (key, values) pairs in provider order, where key is the
+    catalog id (e.g. image_id) and values a dict of field values.
+    Existing rows are read once, compared in memory, and only new or
+    changed rows are written, in batches of chunk_size
+    Returns a dict with the number of inserted, updated and unchanged rows
+    '''
+    existing = dict(
+        (getattr(obj, key), obj) for obj in model.objects.filter(provider=provider))
+    fields = set()
+    new, changed, unchanged = [], [], 0
+    for k, values in rows:
+        values = dict((name, model._meta.get_field(name).to_python(value))
+            for name, value in values.items())
+        obj = existing.get(k)
+        if obj is None:
+            obj = model(provider=provider, **values)
+            setattr(obj, key, k)
+            new.append(obj)
+            continue
+        modified = [name for name, value in values.items()
+            if getattr(obj, name) != value]
+        if modified:
+            for name in modified:
+                setattr(obj, name, values[name])
+            fields.update(modified)
+            changed.append(obj)
+        else:
+            unchanged += 1
+
+    for chunk in chunks(new, chunk_size):
+        bulk_insert(model, chunk)
+    for chunk in chunks(changed, chunk_size):
+        bulk_update(model, chunk, fields)
+    return {
+        'inserted': len(new),
+        'updated': len(changed),
+        'unchanged': unchanged,
+    }
@@ -1,45 +1,80 @@
-from libcloud.compute import types
-from libcloud.compute.base import NodeAuthPassword, NodeAuthSSHKey, Node
-from libcloud.compute.base import NodeImage, NodeSize, NodeLocation
-from libcloud.compute.providers import get_driver
-from libcloud.compute.deployment import SSHKeyDeployment
+# libcloud (and paramiko, which it imports) is only imported when a
+# provider is actually called, most processes never need it
 from provisioning import plugins
+from provisioning.ratelimit import get_bucket, PRIORITY_USER, PRIORITY_SYNC
+from provisioning.ratelimit import RATE_LIMIT_TIMEOUT, INTERACTIVE_TIMEOUT
 from django.conf import settings
-import copy, logging
+from functools import wraps
+import copy, hashlib, logging, os, threading, time, Queue
+
+# Seconds a cached driver instance can stay unused before it is dropped
+DRIVER_CACHE_TTL = 600
+
+# Driver classes per provider type, and driver instances per provider id
+# and thread. Reusing driver instances keeps their (keep-alive) connections
+# and authentication tokens across tasks run by the same worker process.
+# Driver connections aren't thread safe, so threads never share one
+_driver_classes = {}
+_drivers = {}
+_drivers_lock = threading.Lock()
+
+# Provider calls in flight per provider during bulk node actions
+BULK_ACTION_WORKERS = 5
+
+_public_key = None
+
+
+def get_public_key():
+    '''Returns the SSH public key deployed to new nodes
+    It is read from ~/.ssh/<PUBLIC_KEY_FILE> the first time it is needed,
+    unless settings.PUBLIC_KEY is set
+    '''
+    global _public_key
+    if _public_key is None:
+        _public_key = getattr(settings, 'PUBLIC_KEY', None) or open(
+            os.path.expanduser("~/.ssh/%s" % settings.PUBLIC_KEY_FILE)).read()
+    return _public_key
+
+
+def timed(f):
+    '''Adds the time spent in a controller method to its api_time'''
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            self.api_time += time.time() - start
+    return wrapper
 
 
 class ProviderController():
     name = None
     extra_param_name = None
     extra_param_value = None
+    # Seconds spent in provider API calls
+    api_time = 0.0
     
-    def __init__(self, provider):
+    def __init__(self, provider, shared=True):
         self.extra_param_name  = provider.extra_param_name
         self.extra_param_value = provider.extra_param_value
         self.provider_type = provider.provider_type
-        # Get libcloud provider type
-        try:
-            driver_type = types.Provider.__dict__[self.provider_type]
-            # Get driver from libcloud
-            Driver = get_driver(driver_type)
-            logging.debug('selected "%s" libcloud driver' % self.provider_type)
-        except KeyError:
-            # Try to load provider from plugins
-            Driver = plugins.get_driver(self.provider_type)
-            logging.debug('selected "%s" plugin driver' % self.provider_type)
-        except Exception, e:
-            logging.critical(
-                'ProviderController can\'t find a driver for %s' % self.provider_type)
-            raise Exception, "Unknown provider %s" % self.provider_type
-        
-        # Providers with only one access key
-        if provider.secret_key == "":
-            self.conn = Driver(str(provider.access_key))
-        # Providers with 2 keys
+        # Short-lived threads don't keep their driver in the cache
+        if shared:
+            self.conn = get_connection(provider)
         else:
-            self.conn = Driver(str(provider.access_key), str(provider.secret_key))
+            self.conn = new_connection(provider)
+        self.bucket = get_bucket(provider)
+    
+    def _limit(self, priority, timeout=RATE_LIMIT_TIMEOUT):
+        '''Waits for the provider's rate limit before an API call'''
+        if self.bucket is not None:
+            self.bucket.acquire(priority, timeout)
     
     def create_node(self, form):
+        from libcloud.compute.base import NodeAuthPassword, NodeAuthSSHKey
+        from libcloud.compute.base import NodeImage, NodeSize, NodeLocation
+        from libcloud.compute.deployment import SSHKeyDeployment
         name   = form.cleaned_data['name']
         image = form.cleaned_data.get('image')
         if image:
@@ -54,25 +89,26 @@ class ProviderController():
         # Choose node creation strategy
         features = self.conn.features.get('create_node', [])
         try:
+            self._limit(PRIORITY_USER)
             if "ssh_key" in features:
                 # Pass on public key and we are done
                 logging.debug("Provider feature: ssh_key. Pass on key")
                 node = self.conn.create_node(
                     name=name, image=image, size=size, location=location,
-                    auth=NodeAuthSSHKey(settings.PUBLIC_KEY)
+                    auth=NodeAuthSSHKey(get_public_key())
                 )
             elif 'generates_password' in features:
                 # Use deploy_node to deploy public key
                 logging.debug(
                     "Provider feature: generates_password. Use deploy_node")
-                pubkey = SSHKeyDeployment(settings.PUBLIC_KEY) 
+                pubkey = SSHKeyDeployment(get_public_key()) 
                 node = self.conn.deploy_node(
                     name=name, image=image, size=size, location=location,
                     deploy=pubkey
                 )
             elif 'password' in features:
                 # Pass on password and use deploy_node to deploy public key
-                pubkey = SSHKeyDeployment(settings.PUBLIC_KEY)
+                pubkey = SSHKeyDeployment(get_public_key())
                 rpassword = generate_random_password(15)
                 logging.debug("Provider feature: password. Pass on password=%s to deploy_node" % rpassword)
                 node = self.conn.deploy_node(
@@ -98,33 +134,49 @@ class ProviderController():
         
         return None, {
             'public_ips': node.public_ips,
+            'private_ips': node.private_ips,
             'node_id': node.id,
             'state': node.state,
             'extra': node.extra,
         }
     
-    def reboot_node(self, node):
-        '''Reboots a node using node.node_id and self.conn'''
+    def reboot_node(self, node, timeout=INTERACTIVE_TIMEOUT):
+        '''Reboots a node using node.node_id and self.conn
+        Web requests use the default timeout, background tasks can wait
+        longer for the rate limit
+        '''
+        from libcloud.compute.base import Node
+        self._limit(PRIORITY_USER, timeout)
         return self.conn.reboot_node(Node(node.node_id,'','','','',self.conn))
     
-    def destroy_node(self, node):
+    def destroy_node(self, node, timeout=INTERACTIVE_TIMEOUT):
         '''Destroys a node using node.node_id and self.conn'''
+        from libcloud.compute.base import Node
+        self._limit(PRIORITY_USER, timeout)
         return self.conn.destroy_node(Node(node.node_id,'','','','',self.conn))
     
-    def get_nodes(self):
+    @timed
+    def get_nodes(self, priority=PRIORITY_SYNC):
+        self._limit(priority)
         return self.conn.list_nodes()
     
+    @timed
     def get_images(self):
+        self._limit(PRIORITY_SYNC)
         images = self.conn.list_images()
         # Hack for Amazon's EC2: only retrieve AMI images
         if self.provider_type.startswith("EC2"):
             images = [image for image in images if image.id.startswith('ami')]
         return images
     
+    @timed
     def get_sizes(self):
+        self._limit(PRIORITY_SYNC)
         return self.conn.list_sizes()
     
+    @timed
     def get_locations(self):
+        self._limit(PRIORITY_SYNC)
         return self.conn.list_locations()
 
 
@@ -136,3 +188,120 @@ def generate_random_password(length):
     chars.extend([i for i in '\'"!@#$%&*()-_=+[{}]~^,<.>;:/?'])
 
     return ''.join([random.choice(chars) for i in range(length)])
+
+
+def get_driver_class(provider_type):
+    '''Returns the libcloud or plugin Driver class for provider_type'''
+    Driver = _driver_classes.get(provider_type)
+    if Driver is not None:
+        return Driver
+    from libcloud.compute import types
+    from libcloud.compute.providers import get_driver
+    # Get libcloud provider type
+    try:
+        driver_type = types.Provider.__dict__[provider_type]
+        # Get driver from libcloud
+        Driver = get_driver(driver_type)
+        logging.debug('selected "%s" libcloud driver' % provider_type)
+    except KeyError:
+        # Try to load provider from plugins
+        Driver = plugins.get_driver(provider_type)
+        logging.debug('selected "%s" plugin driver' % provider_type)
+    except Exception, e:
+        logging.critical(
+            'ProviderController can\'t find a driver for %s' % provider_type)
+        raise Exception, "Unknown provider %s" % provider_type
+    _driver_classes[provider_type] = Driver
+    return Driver
+
+
+def new_connection(provider):
+    '''Returns a new driver instance for provider'''
+    Driver = get_driver_class(provider.provider_type)
+    # Providers with only one access key
+    if provider.secret_key == "":
+        return Driver(str(provider.access_key))
+    # Providers with 2 keys
+    else:
+        return Driver(str(provider.access_key), str(provider.secret_key))
+
+
+def get_connection(provider):
+    '''Returns a driver instance for provider
+    Instances are reused by the same thread while the provider credentials
+    stay the same and they have been used within the last DRIVER_CACHE_TTL
+    seconds
+    '''
+    creds = hashlib.sha1("\0".join([provider.provider_type,
+        provider.access_key, provider.secret_key]).encode('utf-8')).hexdigest()
+    key = (provider.id, threading.current_thread().ident)
+    now = time.time()
+    with _drivers_lock:
+        for k, (c, conn, last_used) in _drivers.items():
+            if now - last_used > DRIVER_CACHE_TTL:
+                del _drivers[k]
+        cached = _drivers.get(key)
+        if cached is not None and cached[0] == creds:
+            _drivers[key] = (creds, cached[1], now)
+            return cached[1]
+
+    conn = new_connection(provider)
+    # Don't cache connections of providers that haven't been saved yet
+    if provider.id is not None:
+        with _drivers_lock:
+            _drivers[key] = (creds, conn, now)
+    return conn
+
+
+def drop_connection(provider_id):
+    '''Removes the cached driver instances of a provider'''
+    with _drivers_lock:
+        for key in _drivers.keys():
+            if key[0] == provider_id:
+                del _drivers[key]
+
+
+def run_node_actions(action, nodes):
+    '''Calls the controller's reboot_node or destroy_node for all nodes
+    The calls run concurrently, with up to BULK_ACTION_WORKERS in flight
+    per provider. Returns a dict mapping node ids to (result, error)
+    '''
+    by_provider = {}
+    for node in nodes:
+        by_provider.setdefault(node.provider_id, []).append(node)
+    results = {}
+    threads = []
+    for provider_nodes in by_provider.values():
+        queue = Queue.Queue()
+        for node in provider_nodes:
+            queue.put(node)
+        for i in range(min(BULK_ACTION_WORKERS, len(provider_nodes))):
+            t = threading.Thread(target=_node_action_worker,
+                args=(action, provider_nodes[0].provider, queue, results))
+            t.start()
+            threads.append(t)
+    for t in threads:
+        t.join()
+    return results
+
+
+def _node_action_worker(action, provider, queue, results):
+    try:
+        controller = ProviderController(provider, shared=False)
+    except Exception, e:
+        controller, error = None, e
+    while True:
+        try:
+            node = queue.get_nowait()
+        except Queue.Empty:
+            return
+        if controller is None:
+            results[node.id] = (False, str(error))
+            continue
+        try:
+            results[node.id] = (getattr(controller, action + '_node')(
+                node, timeout=RATE_LIMIT_TIMEOUT), None)
+        except Exception, e:
+            logging.error('%s of node %s failed. %s: %s' % (
+                action, node.node_id, type(e), e))
+            results[node.id] = (False, str(e))
@@ -0,0 +1,77 @@
+import datetime
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from provisioning.models import Node, NodeIP, Image, SyncRun
+
+# The queries run most often, with example values
+HOT_QUERIES = [
+    ('active nodes',
+        lambda: Node.objects.filter(environment__in=Node.ACTIVE_ENVIRONMENTS)),
+    ('active nodes of a provider',
+        lambda: Node.objects.filter(
+            provider=1, environment__in=Node.ACTIVE_ENVIRONMENTS)),
+    ('public ips of a node',
+        lambda: NodeIP.objects.filter(
+            node=1, is_public=True).order_by('position')),
+    ('nodeip by address',
+        lambda: NodeIP.objects.filter(address='127.0.0.1')),
+    ('favorite images of a provider',
+        lambda: Image.objects.filter(
+            provider=1, favorite=True).order_by('-last_used')),
+    ('sync runs of a provider',
+        lambda: SyncRun.objects.filter(
+            provider=1, started_at__gte=datetime.datetime(2000, 1, 1))),
+    ('old sync runs',
+        lambda: SyncRun.objects.filter(
+            started_at__lt=datetime.datetime(2000, 1, 1))),
+]
+
+
+def explain(sql, params):
+    '''Returns the query plan lines of sql and whether any is a full scan'''
+    cursor = connection.cursor()
+    engine = connection.settings_dict['ENGINE'].split('.')[-1]
+    if engine == 'sqlite3':
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+        full_scan = [l for l in plan
+            if re.match(r'SCAN (TABLE )?\w+$', l)]
+    elif engine in ('postgresql', 'postgresql_psycopg2'):
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = [row[0] for row in cursor.fetchall()]
+        full_scan = [l for l in plan if 'Seq Scan' in l]
+    elif engine == 'mysql':
+        cursor.execute("EXPLAIN " + sql, params)
+        rows = cursor.fetchall()
+        plan = [" ".join([str(c) for c in row]) for row in rows]
+        scan_type = [c[0] for c in cursor.description].index('type')
+        full_scan = [row for row in rows if row[scan_type] == 'ALL']
+    else:
+        raise CommandError("EXPLAIN not supported for %s" % engine)
+    return plan, bool(full_scan)
+
+
+class Command(BaseCommand):
+    help = 'Checks that the hot Node, NodeIP and Image queries use an index'
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        failed = []
+        for name, query in HOT_QUERIES:
+            sql, params = query().query.get_compiler(
+                connection=connection).as_sql()
+            plan, full_scan = explain(sql, params)
+            if full_scan:
+                failed.append(name)
+            if verbosity >= 1:
+                print('%s %s' % ('FULL SCAN' if full_scan else 'ok', name))
+            if verbosity >= 2:
+                for line in plan:
+                    print('    %s' % line)
+        
+        if failed:
+            raise CommandError(
+                "Queries without a supporting index: %s" % ", ".join(failed))
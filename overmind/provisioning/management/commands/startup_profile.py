@@ -0,0 +1,90 @@
+import json, os, subprocess, sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Modules a web process or worker imports on start
+DEFAULT_MODULES = ['settings', 'provisioning.models', 'provisioning.tasks',
+    'provisioning.views', 'api.urls']
+
+# Run in a new interpreter, where nothing has been imported yet. Times every
+# first import of a module, and prints the modules as JSON:
+# [name, total ms including the modules it imported, own ms]
+PROFILE_SCRIPT = r'''
+import __builtin__, json, sys, time
+_import = __builtin__.__import__
+times = {}
+stack = [[]]
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    before = set(sys.modules)
+    stack.append([])
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        total = time.time() - start
+        children = stack.pop()
+        # Failed implicit relative imports leave None entries
+        new = [m for m in sys.modules if m not in before and m not in times
+            and sys.modules[m] is not None]
+        if new:
+            # Charge the import to the requested module, or else to the
+            # outermost new one
+            named = [m for m in new if m == name or m.endswith('.' + name)]
+            module = min(named or new, key=len)
+            times[module] = (total, total - sum(children))
+            stack[-1].append(total)
+        else:
+            stack[-1].extend(children)
+
+__builtin__.__import__ = timed_import
+start = time.time()
+for name in sys.argv[1:]:
+    __import__(name)
+    if name == 'settings':
+        # Settings are configured on first access
+        from django.conf import settings
+        settings.DEBUG
+total = time.time() - start
+__builtin__.__import__ = _import
+sys.stdout.write(json.dumps({'total': total * 1000, 'modules': [
+    [name, t * 1000, own * 1000] for name, (t, own) in times.items()]}))
+'''
+
+
+class Command(BaseCommand):
+    args = '[module ...]'
+    help = 'Reports the import time of the modules loaded on start'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=20,
+            help='Number of modules to show'),
+        make_option('--sort', dest='sort', default='own',
+            help='Sort by "own" or "total" import time'),
+    )
+
+    def handle(self, *args, **options):
+        # setup_environ() removes the project's parent directory from
+        # sys.path after importing the settings, the child needs it back
+        path = [settings.BASEDIR, os.path.dirname(settings.BASEDIR)] + sys.path
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path),
+            DJANGO_SETTINGS_MODULE=os.environ.get(
+                'DJANGO_SETTINGS_MODULE', 'overmind.settings'))
+        proc = subprocess.Popen(
+            [sys.executable, '-c', PROFILE_SCRIPT] + list(args or DEFAULT_MODULES),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise CommandError("Could not import the modules:\n%s" % err)
+        result = json.loads(out)
+
+        column = {'total': 1, 'own': 2}.get(options['sort'])
+        if column is None:
+            raise CommandError("--sort must be own or total")
+        modules = sorted(result['modules'], key=lambda m: -m[column])
+        self.stdout.write('%8s %8s  %s\n' % ('total ms', 'own ms', 'module'))
+        for name, total, own in modules[:options['limit']]:
+            self.stdout.write('%8.1f %8.1f  %s\n' % (total, own, name))
+        self.stdout.write('Imported %s modules in %.1f ms\n' % (
+            len(result['modules']), result['total']))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from provisioning.bulk import chunks
+from provisioning.models import Node, sync_node_extra
+
+class Command(BaseCommand):
+    help = 'Rebuilds the extra data index of all nodes'
+
+    def handle(self, *args, **options):
+        ids = list(Node.objects.values_list('id', flat=True))
+        for chunk in chunks(ids):
+            sync_node_extra(list(Node.objects.filter(id__in=chunk)))
+        
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity >= 1:
+            print('Successfully indexed extra data of %s nodes' % len(ids))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from provisioning.bulk import chunks, bulk_update
+from provisioning.models import Node, NodeIP
+
+class Command(BaseCommand):
+    help = 'Sets the primary public and private IP of all nodes from their IPs'
+
+    def handle(self, *args, **options):
+        ids = list(Node.objects.values_list('id', flat=True))
+        updated = 0
+        for chunk in chunks(ids):
+            public, private = {}, {}
+            ips = NodeIP.objects.filter(node__in=chunk).order_by('-position')
+            # Walk the IPs backwards so that the lowest position wins
+            for node_id, address, is_public, version in ips.values_list(
+                    'node', 'address', 'is_public', 'version'):
+                if not is_public:
+                    private[node_id] = address
+                elif version == 4:
+                    public[node_id] = address
+
+            changed = []
+            for node_id, public_ip, private_ip in Node.objects.filter(
+                    id__in=chunk).values_list('id', '_public_ip', '_private_ip'):
+                node = Node(id=node_id, _public_ip=public.get(node_id, ''),
+                    _private_ip=private.get(node_id, ''))
+                if (public_ip, private_ip) != (node._public_ip, node._private_ip):
+                    changed.append(node)
+            updated += bulk_update(Node, changed, ['_public_ip', '_private_ip'])
+
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity >= 1:
+            print('Successfully updated the primary IPs of %s nodes' % updated)
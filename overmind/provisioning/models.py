@@ -1,11 +1,21 @@
 import json
 import datetime
+import hashlib
 import logging
+import math
+import random
+import uuid
+from functools import wraps
 
 from IPy import IP
-from django.db import models, transaction
-
-from provisioning.controllers import ProviderController
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+
+from provisioning.bulk import bulk_insert, bulk_update, bulk_delete, chunks
+from provisioning.bulk import upsert_catalog
+from provisioning.controllers import ProviderController, drop_connection
+from provisioning.probe import probe
+from provisioning.ratelimit import PRIORITY_USER
 from provisioning.provider_meta import PROVIDERS
 
 
@@ -29,6 +39,87 @@ def get_state(state):
     return STATES[state]
 
 
+def get_digest(node):
+    '''Returns a fingerprint of the synced info of a libcloud node'''
+    data = [get_state(node.state), node.public_ips, node.private_ips, node.extra]
+    return hashlib.md5(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+def get_decom_name(name, taken):
+    '''Returns the first "DECOMn-name" name that is not in taken'''
+    counter = 1
+    while "DECOM%s-%s" % (counter, name) in taken:
+        counter += 1
+    return "DECOM%s-%s" % (counter, name)
+
+
+# Normalized (address, version) of the IPs parsed so far
+_parsed_ips = {}
+MAX_PARSED_IPS = 50000
+
+
+def parse_ip(address):
+    '''Returns the normalized address and IP version of address'''
+    parsed = _parsed_ips.get(address)
+    if parsed is None:
+        if len(_parsed_ips) >= MAX_PARSED_IPS:
+            _parsed_ips.clear()
+        ip = IP(address)
+        parsed = _parsed_ips[address] = (ip.strFullsize(), ip.version())
+    return parsed
+
+
+# Node sync scheduling, in seconds. Providers whose nodes don't change are
+# synced less and less often, up to SYNC_MAX_INTERVAL
+SYNC_MIN_INTERVAL = 30
+SYNC_MAX_INTERVAL = 600
+# Fraction of the interval randomly added or removed
+SYNC_JITTER = 0.1
+# A sync running longer than this is considered lost (e.g. a worker died)
+SYNC_TIMEOUT = 900
+
+def single_flight(kind):
+    '''Decorator for Provider sync methods. The method only runs if no
+    other process holds the provider's SyncLease for kind, otherwise it
+    is skipped and returns None
+    '''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            owner = uuid.uuid4().hex
+            if not SyncLease.acquire(self, kind, owner):
+                logging.info(
+                    "%s sync for provider %s already running, skipped" % (
+                        kind, self))
+                return None
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                SyncLease.release(self, kind, owner)
+        return wrapper
+    return decorator
+
+
+# Seconds before a provider's images, locations or sizes are fetched again
+CATALOG_MIN_INTERVAL = getattr(settings, 'CATALOG_MIN_INTERVAL', 3600)
+
+# Days SyncRun records are kept, and the percentiles reported for them
+SYNC_RUN_RETENTION = 14
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values, p):
+    '''Returns the nearest-rank p-th percentile of the sorted values'''
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+# Supported action names, keyed by (provider id, provider type)
+_capabilities = {}
+
+
 class Action(models.Model):
     name = models.CharField(unique=True, max_length=20)
     show = models.BooleanField()
@@ -53,6 +144,13 @@ class Provider(models.Model):
     ready   = models.BooleanField(default=False)
     conn    = None
 
+    # Node sync scheduling
+    sync_started_at  = models.DateTimeField(null=True, blank=True)
+    sync_finished_at = models.DateTimeField(null=True, blank=True)
+    sync_duration    = models.FloatField(null=True, blank=True)
+    sync_interval    = models.FloatField(default=SYNC_MIN_INTERVAL)
+    next_sync_at     = models.DateTimeField(null=True, blank=True)
+
     class Meta:
         unique_together = ('provider_type', 'access_key')
 
@@ -85,163 +183,331 @@ class Provider(models.Model):
             except Action.DoesNotExist:
                 raise Exception, 'Unsupported action "%s" specified' % action_name
             self.actions.add(action)
+        _capabilities.pop((self.id, self.provider_type), None)
+
+    def delete(self, *args, **kwargs):
+        _capabilities.pop((self.id, self.provider_type), None)
+        drop_connection(self.id)
+        super(Provider, self).delete(*args, **kwargs)
 
     def supports(self, action):
-        try:
-            self.actions.get(name=action)
-            return True
-        except Action.DoesNotExist:
-            return False
+        # Actions only change when the provider type does, so the supported
+        # set is read once per process and provider type
+        key = (self.id, self.provider_type)
+        actions = _capabilities.get(key)
+        if actions is None:
+            actions = frozenset(self.actions.values_list('name', flat=True))
+            _capabilities[key] = actions
+        return action in actions
 
     def create_connection(self):
         if self.conn is None:
             self.conn = ProviderController(self)
 
-    @transaction.commit_on_success()
+    @single_flight('nodes')
     def import_nodes(self):
-        '''Sync nodes present at a provider with Overmind's DB'''
+        '''Syncs the nodes and records the sync to schedule the next one
+        Only syncs that hold the lease are recorded, a skipped one would
+        end the sync that is running
+        '''
+        self.start_sync()
+        result = None
+        try:
+            result = self._import_nodes()
+        finally:
+            changes = result and (result['created'] + result['updated'] +
+                result['decommissioned'])
+            self.finish_sync(changes)
+        return result
+
+    @transaction.commit_on_success()
+    def _import_nodes(self):
+        '''Sync nodes present at a provider with Overmind's DB
+        Existing nodes, images, sizes and locations are read once and the
+        nodes to create, update and decommission are computed as set
+        differences, so the number of queries doesn't grow with the number
+        of nodes listed by the provider
+        '''
         if not self.supports('list'): return
         self.create_connection()
         nodes = self.conn.get_nodes()
-        # Import nodes not present in the DB
+        listed = dict((str(node.id), node) for node in nodes)
+        existing = dict(
+            (n.node_id, n) for n in Node.objects.filter(provider=self))
+
+        to_update = set(listed) & set(existing)
+        to_decommission = set([node_id for node_id in set(existing) - set(listed)
+            if existing[node_id].environment != 'Decommissioned'
+            and not node_id.startswith('pending-')])
+
+        # Decommission nodes in the DB not listed by the provider first, so
+        # that new nodes can take their names. They were probably removed
+        # from the provider by another tool
+        # TODO: Needs user notification
+        self.decommission_nodes([existing[node_id] for node_id in to_decommission])
+
+        # Names are unique per provider. Nodes still being created at the
+        # provider have a "pending-" placeholder node_id, the create_node
+        # task fills them in
+        names = dict((n.name, node_id) for node_id, n in existing.items()
+            if node_id not in to_decommission)
+        to_create = set()
         for node in nodes:
-            try:
-                n = Node.objects.get(provider=self, node_id=str(node.id))
-            except Node.DoesNotExist:
-                # Create a new Node
+            node_id = str(node.id)
+            if node_id in existing:
+                continue
+            taken_by = names.get(node.name)
+            if taken_by is None:
+                names[node.name] = node_id
+                to_create.add(node_id)
+            elif not taken_by.startswith('pending-'):
+                logging.error("import_nodes(): node %s of provider %s has "
+                    "the same name as node %s, not imported" % (
+                        node_id, self, taken_by))
+
+        # Import nodes not present in the DB
+        if to_create:
+            images = dict(Image.objects.filter(
+                provider=self).values_list('image_id', 'id'))
+            sizes = dict(Size.objects.filter(
+                provider=self).values_list('size_id', 'id'))
+            locs = list(Location.objects.filter(
+                provider=self).values_list('id', flat=True))
+            new_nodes = []
+            for node_id in to_create:
+                node = listed[node_id]
                 logging.info("import_nodes(): adding %s ..." % node)
+                size_id = node.extra.get('instancetype') or\
+                    node.extra.get('flavorId')
                 n = Node(
-                    name       = node.name,
-                    node_id    = str(node.id),
-                    provider   = self,
-                    created_by = 'imported by Overmind',
+                    name        = node.name,
+                    node_id     = node_id,
+                    provider    = self,
+                    created_by  = 'imported by Overmind',
+                    image_id    = images.get(node.extra.get('imageId')),
+                    location_id = locs[0] if len(locs) == 1 else None,
+                    size_id     = sizes.get(size_id),
+                    state       = get_state(node.state),
+                    sync_digest = get_digest(node),
                 )
-                try:
-                    n.image = Image.objects.get(
-                        image_id=node.extra.get('imageId'), provider=self)
-                except Image.DoesNotExist:
-                    n.image = None
-                locs = Location.objects.filter(provider=self)
-                if len(locs) == 1:
-                    n.location = locs[0]
-                else:
-                    n.location = None
-                try:
-                    size_id = node.extra.get('instancetype') or\
-                        node.extra.get('flavorId')
-                    n.size = Size.objects.get(size_id=size_id, provider=self)
-                except Size.DoesNotExist:
-                    n.size = None
-                n.save()
-            # Import/Update node info
-            n.sync_ips(node.public_ips, public=True)
-            n.sync_ips(node.private_ips, public=False)
+                n.save_extra_data(node.extra)
+                new_nodes.append(n)
+            bulk_insert(Node, new_nodes)
+            # Read back the new rows to get their primary keys
+            for n in Node.objects.filter(provider=self):
+                if n.node_id in to_create:
+                    existing[n.node_id] = n
+
+        # Update info of nodes that changed since the last sync
+        updated = []
+        for node_id in to_update:
+            n, node = existing[node_id], listed[node_id]
+            digest = get_digest(node)
+            if n.sync_digest == digest:
+                continue
             n.state = get_state(node.state)
             n.save_extra_data(node.extra)
-            n.save()
-            logging.debug("import_nodes(): succesfully saved %s" % node.name)
-
-        # Delete nodes in the DB not listed by the provider
-        for n in Node.objects.filter(provider=self
-            ).exclude(environment='Decommissioned'):
-            found = False
-            for node in nodes:
-                if n.node_id == str(node.id):
-                    found = True
-                    break
-            # This node was probably removed from the provider by another tool
-            # TODO: Needs user notification
-            if not found:
-                logging.info("import_nodes(): Delete node %s" % n)
-                n.decommission()
-        logging.debug("Finished synching nodes")
-
-    @transaction.commit_on_success()
-    def import_images(self):
+            n.sync_digest = digest
+            updated.append(n)
+        bulk_update(Node, updated, ['state', '_extra_data', 'sync_digest'])
+
+        # Sync the IPs of all new and changed nodes in one go
+        changed = updated + [existing[node_id] for node_id in to_create]
+        if changed:
+            previous = {}
+            for ip in NodeIP.objects.filter(node__provider=self):
+                previous.setdefault((ip.node_id, ip.is_public), []).append(ip)
+            created, moved, deleted = [], [], []
+            for n in changed:
+                node = listed[n.node_id]
+                for ips, public in [(node.public_ips, True),
+                                    (node.private_ips, False)]:
+                    c, m, d = n.diff_ips(
+                        ips, public, previous.get((n.id, public), []))
+                    created += c
+                    moved += m
+                    deleted += d
+            apply_ip_changes(created, moved, deleted)
+            bulk_update(Node, changed, ['_public_ip', '_private_ip'])
+            sync_node_extra(changed)
+
+        logging.debug("Finished synching nodes: %s created, %s updated, "
+            "%s skipped, %s decommissioned" % (len(to_create), len(updated),
+                len(to_update) - len(updated), len(to_decommission)))
+        return {
+            'created': len(to_create),
+            'updated': len(updated),
+            'skipped': len(to_update) - len(updated),
+            'decommissioned': len(to_decommission),
+        }
+
+    def import_catalog(self, kind, model, key, fetch, force=False,
+            delete_stale=False):
+        '''Syncs a catalog (images, locations or sizes) fetched by fetch()
+        The provider isn't asked again within CATALOG_MIN_INTERVAL seconds
+        unless force is True, and nothing is written when the catalog has
+        the same digest as the last one
+        Returns the upsert_catalog result, or None when it wasn't fetched
+        '''
+        now = datetime.datetime.now()
+        try:
+            state = CatalogState.objects.get(provider=self, kind=kind)
+        except CatalogState.DoesNotExist:
+            state = CatalogState(provider=self, kind=kind)
+        if not force and state.checked_at is not None and now - \
+                state.checked_at < datetime.timedelta(seconds=CATALOG_MIN_INTERVAL):
+            logging.debug("%s of provider %s are fresh" % (kind, self))
+            return None
+        rows = fetch()
+        digest = hashlib.md5(json.dumps(rows, sort_keys=True)).hexdigest()
+        if digest == state.digest:
+            CatalogState.objects.filter(id=state.id).update(checked_at=now)
+            logging.debug("%s of provider %s didn't change" % (kind, self))
+            return {'inserted': 0, 'updated': 0, 'unchanged': len(rows)}
+        result = upsert_catalog(model, self, key, rows)
+        if delete_stale:
+            stale = list(model.objects.filter(provider=self).exclude(
+                **{key + '__in': [k for k, v in rows]}).values_list('id', flat=True))
+            bulk_delete(model, stale)
+            result['deleted'] = len(stale)
+        state.digest = digest
+        state.checked_at = now
+        state.save()
+        return result
+
+    @single_flight('images')
+    def import_images(self, force=False):
         '''Get all images from this provider and store them in the DB
-        The transaction.commit_on_success decorator is needed because
-        some providers have thousands of images, which take a long time
-        to save to the DB as separated transactions
+        Some providers have thousands of images, so only new or renamed
+        images are written, in bulk and committed in bounded chunks
         '''
         if not self.supports('images'): return
         self.create_connection()
-        for image in self.conn.get_images():
-            try:
-                # Update image if it exists
-                img = Image.objects.get(image_id=str(image.id), provider=self)
-            except Image.DoesNotExist:
-                # Create new image if it didn't exist
-                img = Image(
-                    image_id = str(image.id),
-                    provider = self,
-                )
-            img.name = image.name
-            img.save()
-            logging.debug(
-                "Added new image '%s' for provider %s" % (img.name, self))
-        logging.info("Imported all images for provider %s" % self)
-
-    @transaction.commit_on_success()
-    def import_locations(self):
+        result = self.import_catalog('images', Image, 'image_id',
+            lambda: [(str(image.id), {'name': image.name})
+                for image in self.conn.get_images()], force)
+        logging.info("Imported all images for provider %s: %s" % (self, result))
+        return result
+
+    @single_flight('locations')
+    def import_locations(self, force=False):
         '''Get all locations from this provider and store them in the DB'''
         if not self.supports('locations'): return
         self.create_connection()
-        for location in self.conn.get_locations():
-            try:
-                # Update location if it exists
-                loc = Location.objects.get(location_id=str(location.id), provider=self)
-            except Location.DoesNotExist:
-                # Create new location if it didn't exist
-                loc = Location(
-                    location_id = location.id,
-                    provider = self,
-                )
-            loc.name    = location.name
-            loc.country = location.country
-            loc.save()
-            logging.debug(
-                "Added new location '%s' for provider %s" % (loc.name, self))
-        logging.info("Imported all locations for provider %s" % self)
-
-    @transaction.commit_on_success()
-    def import_sizes(self):
-        '''Get all sizes from this provider and store them in the DB'''
+        result = self.import_catalog('locations', Location, 'location_id',
+            lambda: [(str(location.id), {
+                'name':    location.name,
+                'country': location.country,
+            }) for location in self.conn.get_locations()], force)
+        logging.info(
+            "Imported all locations for provider %s: %s" % (self, result))
+        return result
+
+    @single_flight('sizes')
+    def import_sizes(self, force=False):
+        '''Get all sizes from this provider and store them in the DB
+        Sizes no longer listed are probably not offered anymore, delete them
+        '''
         if not self.supports('sizes'): return
         self.create_connection()
-        sizes = self.conn.get_sizes()
-
-        # Go through all sizes returned by the provider
-        for size in sizes:
-            try:
-                # Read size
-                s = Size.objects.get(size_id=str(size.id), provider=self)
-            except Size.DoesNotExist:
-                # Create new size if it didn't exist
-                s = Size(
-                    size_id = str(size.id),
-                    provider = self,
-                )
-            # Save/update size info
-            s.name      = size.name
-            s.ram       = size.ram
-            s.disk      = size.disk or ""
-            s.bandwidth = size.bandwidth or ""
-            s.price     = size.price or ""
-            s.save()
-            logging.debug("Saved size '%s' for provider %s" % (s.name, self))
-
-        # Delete sizes in the DB not listed by the provider
-        for s in self.get_sizes():
-            found = False
-            for size in sizes:
-                if s.size_id == str(size.id):
-                    found = True
-                    break
-            # This size is probably not longer offered by the provider
-            if not found:
-                logging.debug("Deleted size %s" % s)
-                s.delete()
-        logging.debug("Finished synching sizes")
+        result = self.import_catalog('sizes', Size, 'size_id',
+            lambda: [(str(size.id), {
+                'name':      size.name,
+                'ram':       size.ram,
+                'disk':      size.disk or "",
+                'bandwidth': size.bandwidth or "",
+                'price':     size.price or "",
+            }) for size in self.conn.get_sizes()], force, delete_stale=True)
+        logging.debug("Finished synching sizes: %s" % result)
+        return result
+
+    @single_flight('probe')
+    def probe_nodes(self, ports=None):
+        '''Sets the state of running and unknown nodes from whether they
+        accept TCP connections on any of ports (default PROBE_PORTS).
+        For providers that can't list their nodes, like dedicated hardware
+        '''
+        nodes = Node.objects.filter(provider=self,
+            environment__in=Node.ACTIVE_ENVIRONMENTS,
+            state__in=['Running', 'Unknown'],
+        ).exclude(_public_ip='').values_list('id', '_public_ip', 'state')
+        up = probe([ip for node_id, ip, state in nodes], ports)
+        changed = {'Running': [], 'Unknown': []}
+        for node_id, ip, state in nodes:
+            new_state = 'Running' if up[ip] else 'Unknown'
+            if new_state != state:
+                changed[new_state].append(node_id)
+        for state, node_ids in changed.items():
+            for chunk in chunks(node_ids):
+                Node.objects.filter(id__in=chunk).update(state=state)
+        return {
+            'up': len([ip for ip in up if up[ip]]),
+            'down': len([ip for ip in up if not up[ip]]),
+            'updated': len(changed['Running']) + len(changed['Unknown']),
+        }
+
+    def decommission_nodes(self, nodes):
+        '''Renames and decommissions all given nodes of this provider at once
+        Runs in the caller's transaction, if any, so that a failed node sync
+        rolls it back
+        '''
+        taken = set(Node.objects.filter(
+            provider=self, name__startswith='DECOM').values_list('name', flat=True))
+        for n in nodes:
+            logging.info("Decommission node %s" % n)
+            n.state = 'Terminated'
+            n.name = get_decom_name(n.name, taken)
+            n.environment = 'Decommissioned'
+            taken.add(n.name)
+        bulk_update(Node, nodes, ['name', 'state', 'environment'])
+
+    def sync_in_flight(self, now=None):
+        now = now or datetime.datetime.now()
+        return self.sync_started_at is not None and \
+            self.sync_finished_at is None and \
+            now - self.sync_started_at < datetime.timedelta(seconds=SYNC_TIMEOUT)
+
+    def sync_due(self, now=None):
+        '''Returns True if a node sync should be started for this provider'''
+        now = now or datetime.datetime.now()
+        if self.sync_in_flight(now):
+            return False
+        return self.next_sync_at is None or self.next_sync_at <= now
+
+    def start_sync(self):
+        self.sync_started_at = datetime.datetime.now()
+        self.sync_finished_at = None
+        Provider.objects.filter(id=self.id).update(
+            sync_started_at=self.sync_started_at, sync_finished_at=None)
+
+    def finish_sync(self, changes):
+        '''Records a finished node sync and schedules the next one
+        The interval is reset when nodes changed and doubled otherwise, and
+        it is never shorter than twice the duration of the sync
+        '''
+        now = datetime.datetime.now()
+        # timedelta.total_seconds() needs Python 2.7
+        d = now - (self.sync_started_at or now)
+        duration = d.days * 86400 + d.seconds + d.microseconds / 1e6
+        if changes:
+            interval = SYNC_MIN_INTERVAL
+        else:
+            interval = min(self.sync_interval * 2, SYNC_MAX_INTERVAL)
+        interval = max(interval, duration * 2)
+        delay = interval * random.uniform(1 - SYNC_JITTER, 1 + SYNC_JITTER)
+
+        self.sync_finished_at = now
+        self.sync_duration = duration
+        self.sync_interval = interval
+        self.next_sync_at = now + datetime.timedelta(seconds=delay)
+        Provider.objects.filter(id=self.id).update(
+            sync_finished_at = self.sync_finished_at,
+            sync_duration    = self.sync_duration,
+            sync_interval    = self.sync_interval,
+            next_sync_at     = self.next_sync_at,
+        )
+        logging.debug("Synced nodes of provider %s in %.1fs, next sync in %ds" % (
+            self, duration, delay))
 
     def update(self):
         logging.debug('Updating provider "%s"...' % self.name)
@@ -251,7 +517,8 @@ class Provider(models.Model):
     def check_credentials(self):
         if not self.supports('list'): return
         self.create_connection()
-        self.conn.get_nodes()
+        # Checked while a user adds the provider
+        self.conn.get_nodes(PRIORITY_USER)
         return True
 
     def get_sizes(self):
@@ -282,6 +549,132 @@ class Provider(models.Model):
         return self.name
 
 
+class SyncLease(models.Model):
+    '''Marks a sync of kind (nodes, images...) running for a provider'''
+    provider   = models.ForeignKey(Provider)
+    kind       = models.CharField(max_length=20)
+    owner      = models.CharField(max_length=32)
+    expires_at = models.DateTimeField()
+
+    def __unicode__(self):
+        return "%s %s" % (self.provider, self.kind)
+
+    class Meta:
+        unique_together  = ('provider', 'kind')
+
+    @classmethod
+    def acquire(cls, provider, kind, owner, timeout=SYNC_TIMEOUT):
+        '''Returns True if owner got the lease, False if someone else holds it'''
+        now = datetime.datetime.now()
+        expires_at = now + datetime.timedelta(seconds=timeout)
+        # Take over an expired lease
+        if cls.objects.filter(provider=provider, kind=kind,
+                expires_at__lt=now).update(owner=owner, expires_at=expires_at):
+            return True
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(provider=provider, kind=kind,
+                owner=owner, expires_at=expires_at)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return False
+        transaction.savepoint_commit(sid)
+        return True
+
+    @classmethod
+    def release(cls, provider, kind, owner):
+        cls.objects.filter(provider=provider, kind=kind, owner=owner).delete()
+
+
+class CatalogState(models.Model):
+    '''Digest of the last catalog of kind (images, sizes...) of a provider'''
+    provider   = models.ForeignKey(Provider)
+    kind       = models.CharField(max_length=20)
+    digest     = models.CharField(max_length=32)
+    checked_at = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return "%s %s" % (self.provider, self.kind)
+
+    class Meta:
+        unique_together  = ('provider', 'kind')
+
+
+class SyncRun(models.Model):
+    '''Timings and row counts of one node or catalog import'''
+    provider   = models.ForeignKey(Provider)
+    kind       = models.CharField(max_length=20)
+    started_at = models.DateTimeField(db_index=True)
+    duration   = models.FloatField()
+    # Time spent waiting for the provider API, and the rest
+    api_time   = models.FloatField()
+    db_time    = models.FloatField()
+    created    = models.PositiveIntegerField(default=0)
+    updated    = models.PositiveIntegerField(default=0)
+    unchanged  = models.PositiveIntegerField(default=0)
+    deleted    = models.PositiveIntegerField(default=0)
+    error      = models.CharField(max_length=200, blank=True)
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.provider, self.kind, self.started_at)
+
+    @classmethod
+    def record(cls, provider, kind, started_at, duration, api_time,
+            result=None, error=''):
+        '''Saves a run from the result of Provider.import_<kind>()'''
+        result = result or {}
+        try:
+            error = unicode(error)
+        except UnicodeError:
+            # Non-ASCII bytes, common in the HTML error pages of providers
+            error = unicode(str(error), 'utf-8', 'replace')
+        return cls.objects.create(
+            provider=provider, kind=kind, started_at=started_at,
+            duration=duration, api_time=api_time,
+            db_time=max(duration - api_time, 0),
+            created=result.get('created', result.get('inserted', 0)),
+            updated=result.get('updated', 0),
+            unchanged=result.get('unchanged', result.get('skipped', 0)),
+            deleted=result.get('deleted', result.get('decommissioned', 0)),
+            error=error[:200],
+        )
+
+    @classmethod
+    def prune(cls, days=SYNC_RUN_RETENTION):
+        '''Deletes the runs older than days'''
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+        pks = list(cls.objects.filter(
+            started_at__lt=cutoff).values_list('id', flat=True))
+        bulk_delete(cls, pks)
+        return len(pks)
+
+    @classmethod
+    def stats(cls, runs):
+        '''Returns the run count, error count, row totals and the
+        duration, api_time and db_time percentiles per provider and kind
+        '''
+        groups = {}
+        for run in runs.order_by('started_at'):
+            groups.setdefault((run.provider_id, run.kind), []).append(run)
+        stats = []
+        for (provider_id, kind), group in sorted(groups.items()):
+            entry = {
+                'provider': provider_id,
+                'kind': kind,
+                'runs': len(group),
+                'errors': len([r for r in group if r.error]),
+            }
+            for field in ['created', 'updated', 'unchanged', 'deleted']:
+                entry[field] = sum([getattr(r, field) for r in group])
+            for field in ['duration', 'api_time', 'db_time']:
+                values = sorted([getattr(r, field) for r in group])
+                entry[field] = dict(
+                    ('p%s' % p, percentile(values, p)) for p in PERCENTILES)
+                entry[field]['max'] = values[-1]
+            stats.append(entry)
+        return stats
+
+
 class Image(models.Model):
     '''OS image model'''
     image_id  = models.CharField(max_length=20)
@@ -334,7 +727,7 @@ class NodeIP(models.Model):
         ('inet6', 6),
     )
     node = models.ForeignKey('Node', related_name='ips')
-    address = models.IPAddressField()
+    address = models.IPAddressField(db_index=True)
     is_public = models.BooleanField(default=True)
     version = models.IntegerField(choices=INET_FAMILIES, default=4)
     position = models.IntegerField()
@@ -343,6 +736,19 @@ class NodeIP(models.Model):
     def __unicode__(self):
         return "%s" % (self.address)
 
+class NodeExtra(models.Model):
+    '''Indexed copy of the scalar values in a node's extra data'''
+    node  = models.ForeignKey('Node', related_name='extra')
+    key   = models.CharField(max_length=50, db_index=True)
+    value = models.CharField(max_length=255, db_index=True)
+
+    def __unicode__(self):
+        return "%s=%s" % (self.key, self.value)
+
+    class Meta:
+        unique_together  = ('node', 'key')
+
+
 class Node(models.Model):
     STATE_CHOICES = (
         (u'Begin', u'Begin'),
@@ -362,6 +768,9 @@ class Node(models.Model):
         (u'Test', u'Test'),
         (u'Decommissioned', u'Decommissioned'),
     )
+    # Filtering by these (instead of excluding Decommissioned) can use an index
+    ACTIVE_ENVIRONMENTS = [
+        e for e, label in ENVIRONMENT_CHOICES if e != u'Decommissioned']
     # Standard node fields
     name        = models.CharField(max_length=25)
     node_id     = models.CharField(max_length=50)
@@ -375,16 +784,28 @@ class Node(models.Model):
     )
     hostname    = models.CharField(max_length=25, blank=True)
     _extra_data = models.TextField(blank=True)
+    # Primary IPs, kept in sync with the NodeIP rows by sync_ips()
+    _public_ip  = models.CharField(max_length=39, blank=True)
+    _private_ip = models.CharField(max_length=39, blank=True)
+    # Digest of the provider info last synced, see get_digest()
+    sync_digest = models.CharField(max_length=32, blank=True)
 
     # Overmind related fields
     environment = models.CharField(
-        default='Production', max_length=2, choices=ENVIRONMENT_CHOICES
+        default='Production', max_length=2, choices=ENVIRONMENT_CHOICES,
+        db_index=True,
     )
     created_by   = models.CharField(max_length=25)
     destroyed_by = models.CharField(max_length=25, blank=True)
     created_at   = models.DateTimeField(auto_now_add=True)
     destroyed_at = models.DateTimeField(null=True)
 
+    @property
+    def pending(self):
+        '''True while the node has a placeholder node_id, that is until the
+        create_node task gets its id from the provider'''
+        return self.node_id.startswith('pending-')
+
     @property
     def public_ips(self):
         return self.ips.filter(is_public=True)
@@ -397,40 +818,55 @@ class Node(models.Model):
     # Backward compatibility properties
     @property
     def public_ip(self):
-        public_ips = self.ips.filter(is_public=True).filter(version=4)
-        if len(public_ips):
-            return public_ips[0].address
-        return ''
+        return self._public_ip
 
     @property
     def private_ip(self):
-        private_ips = self.ips.filter(is_public=False)
-        if len(private_ips):
-            return private_ips[0].address
-        return ''
+        return self._private_ip
+
+    # helpers for related ips creation
+    def diff_ips(self, ips, public, previous):
+        '''Compares the addresses in ips with the NodeIPs in previous
+        Returns the lists of NodeIPs to create, to update and to delete
+        and sets the node's primary public or private IP
+        '''
+        positions = {}
+        versions = {}
+        for position, i in enumerate(ips):
+            address, version = parse_ip(i)
+            positions.setdefault(address, position)
+            versions[address] = version
+        ordered = sorted(positions.keys(), key=lambda a: positions[a])
+        if public:
+            ipv4 = [a for a in ordered if versions[a] == 4]
+            self._public_ip = ipv4[0] if ipv4 else ''
+        else:
+            self._private_ip = ordered[0] if ordered else ''
+
+        current = {}
+        moved, deleted = [], []
+        for p in previous:
+            if p.address not in positions or p.address in current:
+                deleted.append(p)
+                continue
+            current[p.address] = p
+            if p.position != positions[p.address]:
+                p.position = positions[p.address]
+                moved.append(p)
+
+        created = [NodeIP(
+                address=address, position=positions[address],
+                version=versions[address], is_public=public, node=self,
+            ) for address in ordered if address not in current]
+        return created, moved, deleted
 
-    # helper for related ips creation
     def sync_ips(self, ips, public=True):
         """Sync IP for a node"""
-        previous = self.ips.filter(is_public=public).order_by('position')
-        addrs = []
-        for i in ips:
-            addr = IP(i)
-            addrs.append(addr)
-        new_ips = [x.strFullsize() for x in addrs]
-        for p in previous:
-            if p.address in new_ips:
-                p.position = new_ips.index(p.address)
-            else:
-                p.delete()
-        for a in addrs:
-            if a.strFullsize() not in [x.address for x in previous]:
-                # Create new nodeip object
-                NodeIP.objects.create(
-                    address=a.strFullsize(),
-                    position=new_ips.index(a.strFullsize()),
-                    version=a.version(), is_public=public, node=self
-                )
+        primary = (self._public_ip, self._private_ip)
+        apply_ip_changes(
+            *self.diff_ips(ips, public, self.ips.filter(is_public=public)))
+        if primary != (self._public_ip, self._private_ip):
+            bulk_update(Node, [self], ['_public_ip', '_private_ip'])
 
     class Meta:
         unique_together  = (('provider', 'name'), ('provider', 'node_id'))
@@ -440,11 +876,24 @@ class Node(models.Model):
 
     def save_extra_data(self, data):
         self._extra_data = json.dumps(data)
+        self._extra_cache = data
 
     def extra_data(self):
-        if self._extra_data == '':
-            return {}
-        return json.loads(self._extra_data)
+        if not hasattr(self, '_extra_cache'):
+            if self._extra_data == '':
+                self._extra_cache = {}
+            else:
+                self._extra_cache = json.loads(self._extra_data)
+        return self._extra_cache
+
+    def extra_rows(self):
+        '''Returns the NodeExtra rows that index this node's extra data'''
+        data = self.extra_data()
+        if not isinstance(data, dict):
+            return []
+        return [NodeExtra(node=self, key=key[:50], value=unicode(value)[:255])
+            for key, value in data.items()
+            if isinstance(value, (basestring, int, long, float, bool))]
 
     def reboot(self):
         '''Returns True if the reboot was successful, otherwise False'''
@@ -477,17 +926,25 @@ class Node(models.Model):
         '''Rename node and set its environment to decomissioned'''
         self.state = 'Terminated'
         # Rename node to free the name for future use
-        counter = 1
-        newname = "DECOM" + str(counter) + "-" + self.name
-        while(len(Node.objects.filter(
-                provider=self.provider,name=newname
-            ).exclude(
-                id=self.id
-            ))):
-            counter += 1
-            newname = "DECOM" + str(counter) + "-" + self.name
-        self.name = newname
+        taken = Node.objects.filter(
+            provider=self.provider_id,
+            name__startswith='DECOM', name__endswith='-' + self.name,
+        ).exclude(id=self.id).values_list('name', flat=True)
+        self.name = get_decom_name(self.name, set(taken))
 
         # Mark as decommissioned and save
         self.environment  = 'Decommissioned'
         self.save()
+
+def apply_ip_changes(created, moved, deleted):
+    '''Writes the NodeIP changes computed by Node.diff_ips()'''
+    bulk_insert(NodeIP, created)
+    bulk_update(NodeIP, moved, ['position'])
+    bulk_delete(NodeIP, [p.id for p in deleted])
+
+
+def sync_node_extra(nodes):
+    '''Rebuilds the NodeExtra rows of the given (saved) nodes'''
+    for chunk in chunks([n.id for n in nodes]):
+        NodeExtra.objects.filter(node__in=chunk).delete()
+    bulk_insert(NodeExtra, [row for n in nodes for row in n.extra_rows()])
@@ -1,27 +1,62 @@
 # Provisioning plugins module
+# Plugin metadata is read from the module-level assignments of the plugin
+# files without importing them, so that their dependencies (httplib2,
+# IPy...) are only imported when a plugin's Driver is actually needed
+import ast, os
+
+# Module-level names read as the metadata of a plugin
+META_NAMES = ['display_name', 'access_key', 'secret_key', 'form_fields',
+    'supported_actions', 'rate_limit']
+
+_plugins = None
+_drivers = {}
+
 
 def get_driver(provider):
     """Gets a driver
     @param provider: name of provider to get driver
     """
-    _mod = __import__(provider, globals(), locals())
-    return getattr(_mod, "Driver")
+    Driver = _drivers.get(provider)
+    if Driver is None:
+        _mod = __import__(provider, globals(), locals())
+        Driver = _drivers[provider] = getattr(_mod, "Driver")
+    return Driver
+
+def read_meta(path):
+    '''Returns the metadata assignments of a plugin file, which must be
+    literals (strings, lists, None...)
+    '''
+    meta = {}
+    for node in ast.parse(open(path).read(), path).body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+            continue
+        target = node.targets[0]
+        if isinstance(target, ast.Name) and target.id in META_NAMES:
+            meta[target.id] = ast.literal_eval(node.value)
+    return meta
 
 def load_plugins():
-    import os
+    global _plugins
+    if _plugins is not None:
+        return _plugins
     plugin_list = {}
-    for f in os.listdir(os.path.dirname(__file__)):
+    directory = os.path.dirname(__file__)
+    for f in os.listdir(directory):
         if f.endswith('.py') and f != '__init__.py' and f != 'providerplugin.py':
-            driver_name = f.rstrip('.py')
-            _mod = __import__(driver_name, globals(), locals())
-            
+            driver_name = f[:-len('.py')]
+            _mod = read_meta(os.path.join(directory, f))
+
             meta = {
-                'display_name': _mod.display_name,
-                'access_key': _mod.access_key,
-                'secret_key': _mod.secret_key,
+                'display_name': _mod['display_name'],
+                'access_key': _mod['access_key'],
+                'secret_key': _mod['secret_key'],
                 'plugin'    : True,
-                'form_fields': _mod.form_fields,
-                'supported_actions': _mod.supported_actions,
+                'form_fields': _mod['form_fields'],
+                'supported_actions': _mod['supported_actions'],
             }
+            # (requests per second, burst), None for no limit
+            if 'rate_limit' in _mod:
+                meta['rate_limit'] = _mod['rate_limit']
             plugin_list[driver_name] = meta
-    return plugin_list
+    _plugins = plugin_list
+    return _plugins
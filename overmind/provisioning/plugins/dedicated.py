@@ -7,6 +7,7 @@ access_key   = None
 secret_key   = None
 form_fields  = ['ip']
 supported_actions = ['create']
+rate_limit   = None
 
 
 class Connection(ConnectionKey):
@@ -47,7 +48,7 @@ class Driver(NodeDriver):
         n = Node(id=ip.replace(".",""),
                  name=kwargs.get('name'),
                  state=NodeState.RUNNING,
-                 public_ip=[ip],
-                 private_ip=[],
+                 public_ips=[ip],
+                 private_ips=[],
                  driver=self)
         return n
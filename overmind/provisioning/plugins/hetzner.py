@@ -1,5 +1,5 @@
 # Hetzner plugin
-import json
+import json, logging, threading, time, Queue
 from urllib import urlencode
 
 from libcloud.compute.base import NodeDriver, Node
@@ -13,13 +13,91 @@ form_fields  = None
 # It seems that reboot (reset in the Hetzner API) doesn't work, so don't add
 supported_actions = ['list']
 
+# Server detail requests in flight during list_nodes
+DETAIL_WORKERS = 8
+
+# Seconds GET responses are cached, by path prefix (first match wins).
+# Server details are also dropped when the server list shows a change
+CACHE_TTLS = [
+    ('server/', 600),
+    ('server', 20),
+]
+# Responses cached per account
+CACHE_MAX_ENTRIES = 1000
+
+
+class ResponseCache(object):
+    '''Bounded LRU cache of response bodies with a TTL per path'''
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = {}
+        # Paths from least to most recently used
+        self.order = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def ttl(self, path):
+        for prefix, ttl in CACHE_TTLS:
+            if path.startswith(prefix):
+                return ttl
+        return 0
+
+    def _drop(self, path):
+        if self.entries.pop(path, None) is not None:
+            self.order.remove(path)
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[1] < time.time():
+                self._drop(path)
+                self.misses += 1
+                return None
+            self.order.remove(path)
+            self.order.append(path)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, path, content):
+        ttl = self.ttl(path)
+        if not ttl: return
+        with self.lock:
+            self._drop(path)
+            self.entries[path] = (content, time.time() + ttl)
+            self.order.append(path)
+            while len(self.order) > self.max_entries:
+                del self.entries[self.order.pop(0)]
+
+    def invalidate(self, path=None):
+        '''Drops the response for path, or all of them'''
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                del self.order[:]
+            else:
+                self._drop(path)
+
 
 class Connection():
     host = "https://robot-ws.your-server.de/"
 
     def __init__(self, user, password):
-        self.conn = httplib2.Http(".cache")
-        self.conn.add_credentials(user, password)
+        self.user = user
+        self.password = password
+        # httplib2.Http objects aren't thread safe. Keep a pool of them so
+        # that concurrent requests each get one, and reuse them to keep
+        # their connections alive
+        self.pool = Queue.Queue()
+        self.cache = ResponseCache()
+
+    def _get_http(self):
+        try:
+            return self.pool.get_nowait()
+        except Queue.Empty:
+            http = httplib2.Http()
+            http.add_credentials(self.user, self.password)
+            return http
 
     def _raise_error(self, response, content):
         if response.get('status') == '400':
@@ -37,14 +115,28 @@ class Connection():
 
     def request(self, path, method='GET', params=None):
         if method != 'GET' and method != 'POST': return None
+        if method == 'GET':
+            content = self.cache.get(path)
+            if content is not None:
+                return json.loads(content)
+        else:
+            # Never cache calls like reset/, and don't trust what was
+            # cached before them
+            self.cache.invalidate()
         data = None
         if params: data = urlencode(params)
-        response, content = self.conn.request(
-            self.host + path,
-            method,
-            data,
-        )
+        http = self._get_http()
+        try:
+            response, content = http.request(
+                self.host + path,
+                method,
+                data,
+            )
+        finally:
+            self.pool.put(http)
         if response.get('status') == '200':
+            if method == 'GET':
+                self.cache.set(path, content)
             return json.loads(content)
         else:
             self._raise_error(response, content)
@@ -61,12 +153,64 @@ class Driver(NodeDriver):
 
     def __init__(self, user, password):
         self.connection = Connection(user, password)
+        # Last server list entry of every server, by server IP
+        self.servers = {}
+        self.servers_lock = threading.Lock()
+
+    def _get_detail(self, server):
+        '''Returns the server/<ip> response for a server list entry
+        A cached response is only used while the list entry is the same
+        '''
+        ip = server['server_ip']
+        path = 'server/%s' % ip
+        with self.servers_lock:
+            if self.servers.get(ip) != server:
+                self.connection.cache.invalidate(path)
+                self.servers[ip] = dict(server)
+        return self.connection.request(path)
+
+    def _detail_worker(self, queue, responses):
+        while True:
+            try:
+                i, server = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                responses[i] = self._get_detail(server)
+            except Exception, e:
+                responses[i] = e
+
+    def _get_details(self, servers):
+        '''Fetches the details of all servers with up to DETAIL_WORKERS
+        requests in flight. Returns the responses in the same order
+        '''
+        queue = Queue.Queue()
+        for i, server in enumerate(servers):
+            queue.put((i, server))
+        responses = [None] * len(servers)
+        threads = [threading.Thread(target=self._detail_worker,
+            args=(queue, responses))
+            for i in range(min(DETAIL_WORKERS, len(servers)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+        return responses
 
     def _parse_nodes(self, data):
+        servers = [n['server'] for n in data]
+        # Forget servers that are gone
+        with self.servers_lock:
+            ips = set([server['server_ip'] for server in servers])
+            for ip in self.servers.keys():
+                if ip not in ips:
+                    del self.servers[ip]
+                    self.connection.cache.invalidate('server/%s' % ip)
         nodes = []
-        for n in data:
-            nodedata = n['server']
-            response = self.connection.request('server/%s' % nodedata['server_ip'])
+        for nodedata, response in zip(servers, self._get_details(servers)):
             nodedata['extra_ips'] = ", ".join(response['server']['ip'])
             # dict.get() will return None even if we write get('subnet', [])
             subnets = response['server'].get('subnet') or []
@@ -79,8 +223,8 @@ class Driver(NodeDriver):
         n = Node(id=el.get('server_ip').replace(".",""),
                  name=el.get('server_ip'),
                  state=self.NODE_STATE_MAP.get(el.get('status'), NodeState.UNKNOWN),
-                 public_ip=public_ip,
-                 private_ip=[],
+                 public_ips=public_ip,
+                 private_ips=[],
                  driver=self,
                  extra={
                     'location':   el.get('dc'),
@@ -98,10 +242,12 @@ class Driver(NodeDriver):
         nodes = []
         for node in self._parse_nodes(response):
             nodes.append(self._to_node(node))
+        logging.debug("Hetzner response cache: %s hits, %s misses" % (
+            self.connection.cache.hits, self.connection.cache.misses))
         return nodes
 
     def reboot(self, node):
         params = { 'type': 'sw' }#Support hd reset?
         response = self.connection.request(
-            'reset/' + node.public_ip[0] + "/", method='POST', params=params
+            'reset/' + node.public_ips[0] + "/", method='POST', params=params
         )
@@ -0,0 +1,76 @@
+# TCP liveness probing
+# Connects to many addresses at once from a single thread: sockets are
+# non-blocking and select() reports the connections that finished
+import errno, select, socket, time
+from collections import deque
+
+from django.conf import settings
+
+# Ports tried on every address. An address is up if any of them accepts
+PROBE_PORTS = getattr(settings, 'PROBE_PORTS', [22])
+# Seconds to wait for a connection
+PROBE_TIMEOUT = getattr(settings, 'PROBE_TIMEOUT', 3)
+# Connections in flight. Keep it well under select()'s limit of 1024 fds
+PROBE_CONCURRENCY = getattr(settings, 'PROBE_CONCURRENCY', 256)
+
+
+def _connect(address, port):
+    '''Starts connecting to address:port
+    Returns (socket, connected), socket is None if it failed right away
+    '''
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    try:
+        # Fails for families the host doesn't support, e.g. without IPv6
+        sock = socket.socket(family, socket.SOCK_STREAM)
+    except socket.error:
+        return None, False
+    sock.setblocking(0)
+    try:
+        err = sock.connect_ex((address, port))
+    except socket.error:
+        err = errno.EINVAL
+    if err == 0:
+        return sock, True
+    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        return sock, False
+    sock.close()
+    return None, False
+
+
+def probe(addresses, ports=None, timeout=PROBE_TIMEOUT,
+        concurrency=PROBE_CONCURRENCY):
+    '''Returns a dict telling for every address whether it accepted
+    a TCP connection on any of ports
+    '''
+    ports = ports or PROBE_PORTS
+    up = dict((address, False) for address in addresses)
+    pending = deque([(a, p) for a in up for p in ports])
+    in_flight = {}
+    while pending or in_flight:
+        while pending and len(in_flight) < concurrency:
+            address, port = pending.popleft()
+            if up[address]:
+                continue
+            sock, connected = _connect(address, port)
+            if connected:
+                up[address] = True
+                sock.close()
+            elif sock is not None:
+                in_flight[sock] = (address, time.time() + timeout)
+        if not in_flight:
+            continue
+
+        wait = min([d for a, d in in_flight.values()]) - time.time()
+        socks = in_flight.keys()
+        r, done, failed = select.select([], socks, socks, max(wait, 0))
+        for sock in set(done) | set(failed):
+            address = in_flight.pop(sock)[0]
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                up[address] = True
+            sock.close()
+        now = time.time()
+        for sock, (address, deadline) in in_flight.items():
+            if deadline <= now:
+                del in_flight[sock]
+                sock.close()
+    return up
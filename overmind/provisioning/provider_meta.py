@@ -7,6 +7,8 @@ LIBCLOUD_PROVIDERS = {
         'display_name': 'Dummy Provider',
         'access_key': 'Dummy Access Key',
         'secret_key': None,
+        # No API to protect
+        'rate_limit': None,
     },
     'EC2_US_WEST': {
         'display_name': 'EC2 US West',
@@ -0,0 +1,104 @@
+# Provider API rate limiting
+# Every provider account gets a token bucket. Buckets are kept in small
+# files so that all worker processes on a host share them. Each provider
+# call takes a token; sync calls leave a reserve of tokens for user actions
+import errno, fcntl, hashlib, os, tempfile, time
+
+from django.conf import settings
+from provisioning.provider_meta import PROVIDERS
+
+# (requests per second, burst) used for provider types without a rate_limit
+DEFAULT_RATE_LIMIT = (5.0, 20)
+
+# Fraction of the burst that sync calls can't use
+SYNC_RESERVE = 0.25
+
+# Seconds a call waits for a token before giving up. Calls made while a
+# user waits for a web response give up sooner
+RATE_LIMIT_TIMEOUT = 120
+INTERACTIVE_TIMEOUT = 5
+
+PRIORITY_USER = 0
+PRIORITY_SYNC = 1
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, key, rate, burst, directory=None):
+        self.rate  = float(rate)
+        self.burst = burst
+        if directory is None:
+            directory = getattr(settings, 'RATE_LIMIT_DIR',
+                os.path.join(tempfile.gettempdir(), 'overmind-ratelimit'))
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+        self.path = os.path.join(directory, key)
+
+    def _take(self, reserve):
+        '''Takes a token if more than reserve are left
+        Returns 0, or the seconds until enough tokens are available
+        '''
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                tokens, updated = map(float, os.read(fd, 64).split())
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            except ValueError:
+                # New or corrupt bucket
+                tokens = self.burst
+            wait = 0
+            if tokens - 1 >= reserve:
+                tokens -= 1
+            else:
+                wait = (reserve + 1 - tokens) / self.rate
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, "%f %f" % (tokens, now))
+            return wait
+        finally:
+            os.close(fd)
+
+    def acquire(self, priority=PRIORITY_USER, timeout=RATE_LIMIT_TIMEOUT):
+        '''Waits until a token can be taken
+        Raises RateLimitExceeded when that takes longer than timeout seconds
+        '''
+        reserve = 0
+        if priority != PRIORITY_USER:
+            reserve = self.burst * SYNC_RESERVE
+        deadline = time.time() + timeout
+        while True:
+            wait = self._take(reserve)
+            if not wait:
+                return
+            if time.time() + wait > deadline:
+                raise RateLimitExceeded("Provider API rate limit reached, "
+                    "no requests left for %ss. Retry later" % timeout)
+            time.sleep(wait)
+
+
+def get_rate_limit(provider_type):
+    '''Returns the (rate, burst) for provider_type, or None for no limit
+    settings.PROVIDER_RATE_LIMITS overrides the rate_limit in provider_meta
+    '''
+    limits = getattr(settings, 'PROVIDER_RATE_LIMITS', {})
+    if provider_type in limits:
+        return limits[provider_type]
+    return PROVIDERS.get(provider_type, {}).get('rate_limit', DEFAULT_RATE_LIMIT)
+
+
+def get_bucket(provider):
+    '''Returns the token bucket of a provider account, or None'''
+    limit = get_rate_limit(provider.provider_type)
+    if limit is None:
+        return None
+    # Providers sharing credentials share the account limits
+    key = hashlib.sha1("\0".join([provider.provider_type,
+        provider.access_key]).encode('utf-8')).hexdigest()
+    return TokenBucket(key, *limit)
@@ -0,0 +1,3 @@
+-- Favorite images of a provider, most recently used first
+CREATE INDEX provisioning_image_provider_id_favorite_last_used
+    ON provisioning_image (provider_id, favorite, last_used);
@@ -0,0 +1,3 @@
+-- Nodes of a provider, optionally filtered by environment
+CREATE INDEX provisioning_node_provider_id_environment
+    ON provisioning_node (provider_id, environment);
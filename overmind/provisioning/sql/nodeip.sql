@@ -0,0 +1,3 @@
+-- A node's public or private IPs in order
+CREATE INDEX provisioning_nodeip_node_id_is_public_position
+    ON provisioning_nodeip (node_id, is_public, position);
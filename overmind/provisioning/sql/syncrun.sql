@@ -0,0 +1,3 @@
+-- Sync runs of a provider within a time window
+CREATE INDEX provisioning_syncrun_provider_id_started_at
+    ON provisioning_syncrun (provider_id, started_at);
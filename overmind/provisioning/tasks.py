@@ -1,53 +1,128 @@
-from celery.task import task, periodic_task
-from celery.task.sets import subtask
-from libcloud.common.types import InvalidCredsException
-from provisioning.models import Provider
-from datetime import timedelta
+from celery.task import task, periodic_task, chord
+from django.conf import settings
+from provisioning.bulk import chunks
+from provisioning.controllers import run_node_actions
+from provisioning.forms import NodeForm
+from provisioning.models import Provider, Node, SyncRun, get_state
+from provisioning.models import sync_node_extra
+from datetime import datetime, timedelta
+import time
 
 
 @periodic_task(run_every=timedelta(seconds=30))
 def update_providers(**kwargs):
     logger = update_providers.get_logger(**kwargs)
     logger.debug("Syncing providers...")
+    now = datetime.now()
     for prov in Provider.objects.filter(ready=True):
+        # Skip providers that synced recently or are still syncing
+        if not prov.sync_due(now):
+            continue
+        prov.start_sync()
         import_sizes.delay(prov.id)
         import_nodes.delay(prov.id)
 
+@periodic_task(run_every=timedelta(seconds=60))
+def probe_nodes(**kwargs):
+    '''Updates the state of nodes of providers that can't list them'''
+    logger = probe_nodes.get_logger(**kwargs)
+    for prov in Provider.objects.all():
+        if prov.supports('list'):
+            continue
+        result = prov.probe_nodes()
+        if result is not None:
+            logger.debug('Probed nodes of provider %s: %s' % (prov, result))
+
+@periodic_task(run_every=timedelta(days=1))
+def prune_sync_runs(**kwargs):
+    logger = prune_sync_runs.get_logger(**kwargs)
+    logger.info("Deleted %s old sync runs" % SyncRun.prune())
+
 @task()
 def import_provider_info(provider_id, **kwargs):
     logger = import_provider_info.get_logger(**kwargs)
     prov = Provider.objects.get(id=provider_id)
     logger.debug('Importing info for provider %s...' % prov)
-    import_images.delay(provider_id, callback=subtask(import_locations,
-                                callback=subtask(import_sizes,
-                                    callback=subtask(import_nodes))))
+    # Images, locations and sizes don't depend on each other, so import them
+    # in parallel and import the nodes once all of them finished.
+    # They are fetched even if they were fetched recently, as the provider
+    # may be new or have new credentials
+    stages = [import_catalog.subtask((provider_id, kind), {'force': True})
+        for kind in ('images', 'locations', 'sizes')]
+    if getattr(settings, 'CELERY_ALWAYS_EAGER', False):
+        # Eager chords run their callback before the header tasks. Run the
+        # stages in turn and pass failed ones on as their exception, like
+        # the chord does
+        results = []
+        for stage in stages:
+            try:
+                results.append(stage.apply().result)
+            except Exception, e:
+                results.append(e)
+        import_catalog_done.apply((results, provider_id))
+    else:
+        chord(stages)(import_catalog_done.subtask((provider_id,)))
+
+def timed_import(prov, kind, logger, **options):
+    '''Runs prov.import_<kind>() and records it as a SyncRun
+    Returns the import result and duration
+    '''
+    logger.debug('Importing %s for provider %s...' % (kind, prov))
+    started_at = datetime.now()
+    start = time.time()
+    result, error = None, None
+    try:
+        result = getattr(prov, 'import_' + kind)(**options)
+    except Exception, e:
+        error = e
+        raise
+    finally:
+        duration = time.time() - start
+        # Imports skipped because another one is running aren't recorded
+        if result is not None or error is not None:
+            api_time = prov.conn.api_time if prov.conn is not None else 0
+            SyncRun.record(prov, kind, started_at, duration, api_time,
+                result, error or '')
+    return {'kind': kind, 'duration': duration, 'result': result}
 
 @task(ignore_result=True)
-def import_images(provider_id, callback=None, **kwargs):
+def import_images(provider_id, force=False, **kwargs):
     logger = import_images.get_logger(**kwargs)
     prov = Provider.objects.get(id=provider_id)
-    logger.debug('Importing images for provider %s...' % prov)
-    prov.import_images()
-    if callback:
-        subtask(callback).delay(provider_id)
+    timed_import(prov, 'images', logger, force=force)
 
 @task(ignore_result=True)
-def import_locations(provider_id, callback=None, **kwargs):
+def import_locations(provider_id, force=False, **kwargs):
     logger = import_locations.get_logger(**kwargs)
     prov = Provider.objects.get(id=provider_id)
-    logger.debug('Importing locations for provider %s...' % prov)
-    prov.import_locations()
-    if callback:
-        subtask(callback).delay(provider_id)
+    timed_import(prov, 'locations', logger, force=force)
 
 @task(ignore_result=True)
-def import_sizes(provider_id, callback=None, **kwargs):
+def import_sizes(provider_id, force=False, **kwargs):
     logger = import_sizes.get_logger(**kwargs)
     prov = Provider.objects.get(id=provider_id)
-    logger.debug('Importing sizes for provider %s...' % prov)
-    prov.import_sizes()
-    if callback:
-        subtask(callback).delay(provider_id)
+    timed_import(prov, 'sizes', logger, force=force)
+
+@task()
+def import_catalog(provider_id, kind, force=False, **kwargs):
+    '''Imports the images, locations or sizes of a provider as a stage of
+    import_provider_info. Keeps its result for import_catalog_done'''
+    logger = import_catalog.get_logger(**kwargs)
+    prov = Provider.objects.get(id=provider_id)
+    return timed_import(prov, kind, logger, force=force)
+
+@task(ignore_result=True)
+def import_catalog_done(results, provider_id, **kwargs):
+    logger = import_catalog_done.get_logger(**kwargs)
+    for stage in results:
+        # Failed stages are passed as their exception
+        if not isinstance(stage, dict):
+            logger.error('Catalog import failed for provider %s: %s' % (
+                provider_id, stage))
+            continue
+        logger.info('Imported %s for provider %s in %.1fs: %s' % (
+            stage['kind'], provider_id, stage['duration'], stage['result']))
+    import_nodes.delay(provider_id)
 
 
 @task(ignore_result=True)
@@ -55,7 +130,86 @@ def import_nodes(provider_id, **kwargs):
     logger = import_nodes.get_logger(**kwargs)
     prov = Provider.objects.get(id=provider_id)
     logger.debug('Importing nodes for provider %s...' % prov)
-    prov.import_nodes()
+    timed_import(prov, 'nodes', logger)
     if not prov.ready:
         prov.ready = True
         prov.save()
+
+@task(ignore_result=True)
+def create_node(node_id, data, **kwargs):
+    '''Creates a node saved by views.save_new_node at its provider'''
+    logger = create_node.get_logger(**kwargs)
+    try:
+        node = Node.objects.get(id=node_id)
+    except Node.DoesNotExist:
+        logger.error('Could not create node %s: it was deleted' % node_id)
+        return
+    # Failing to create the node decommissions it, otherwise it would stay
+    # Pending and keep its name taken
+    try:
+        Node.objects.filter(id=node.id).update(state='Pending')
+        form = NodeForm(node.provider_id, data, instance=node)
+        if form.is_valid():
+            error, data_from_provider = node.provider.create_node(form)
+        else:
+            error = 'Invalid node data: %s' % form.errors.keys()
+    except Exception, e:
+        logger.exception('Error creating node %s' % node.name)
+        error = e
+    if error is not None:
+        logger.error('Could not create node %s: %s' % (node.name, error))
+        node.save_extra_data({'error': str(error)})
+        node.decommission()
+        return
+
+    # The node exists at the provider now. Save its id first, and don't
+    # decommission it if saving the rest fails
+    try:
+        node.node_id = str(data_from_provider['node_id'])
+        Node.objects.filter(id=node.id).update(node_id=node.node_id)
+        node.state   = get_state(data_from_provider['state'])
+        node.save_extra_data(data_from_provider.get('extra', ''))
+        node.save()
+        node.sync_ips(data_from_provider.get('public_ips', []), public=True)
+        node.sync_ips(data_from_provider.get('private_ips', []), public=False)
+        sync_node_extra([node])
+    except Exception:
+        logger.exception('Node %s was created at the provider, but saving '
+            'its data failed' % node.name)
+        return
+    logger.info('New node created %s' % node)
+
+@task()
+def node_action(action, node_ids, username, **kwargs):
+    '''Reboots or destroys many nodes, returns the result per node id'''
+    logger = node_action.get_logger(**kwargs)
+    nodes = []
+    for chunk in chunks(node_ids):
+        nodes += Node.objects.select_related('provider').filter(
+            id__in=chunk, environment__in=Node.ACTIVE_ENVIRONMENTS)
+    # Nodes still being created don't have their provider id yet
+    results = dict((n.id, (False, 'Node is still being created'))
+        for n in nodes if n.pending)
+    nodes = [n for n in nodes if not n.pending]
+    logger.debug('Running %s on %s nodes...' % (action, len(nodes)))
+    # Providers that don't support the action have nothing to do
+    results.update((n.id, (True, None)) for n in nodes)
+    results.update(run_node_actions(
+        action, [n for n in nodes if n.provider.supports(action)]))
+
+    if action == 'destroy':
+        destroyed = {}
+        for n in nodes:
+            if results[n.id][0]:
+                destroyed.setdefault(n.provider, []).append(n)
+        for prov, prov_nodes in destroyed.items():
+            prov.decommission_nodes(prov_nodes)
+            for chunk in chunks([n.id for n in prov_nodes]):
+                Node.objects.filter(id__in=chunk).update(
+                    destroyed_by=username, destroyed_at=datetime.now())
+
+    response = {}
+    for node_id in node_ids:
+        result, error = results.get(int(node_id), (False, 'Node not found'))
+        response[str(node_id)] = {'result': bool(result), 'error': error}
+    return response
@@ -0,0 +1,776 @@
+import datetime, json, shutil, socket, tempfile, threading, time
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from libcloud.compute.types import NodeState
+
+from provisioning import models, tasks
+from provisioning import plugins
+from provisioning.plugins import hetzner
+from provisioning.models import Provider, Node, Image, Size, Location
+from provisioning.models import SyncLease, SyncRun
+from provisioning.models import CatalogState, percentile
+from provisioning.controllers import get_connection
+from provisioning.probe import probe
+from provisioning.ratelimit import TokenBucket, RateLimitExceeded
+from provisioning.ratelimit import PRIORITY_USER, PRIORITY_SYNC
+
+
+class ImportNodesTest(TestCase):
+    def setUp(self):
+        # A numeric access key makes the dummy driver list that many nodes
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="3")
+        self.p.save()
+
+    def test_import_new_nodes(self):
+        '''Should create a node for every node listed by the provider'''
+        result = self.p.import_nodes()
+        self.assertEquals(result['created'], 3)
+        self.assertEquals(Node.objects.filter(provider=self.p).count(), 3)
+        n = Node.objects.get(provider=self.p, name='dummy-1')
+        self.assertEquals(n.state, 'Running')
+        self.assertEquals(n.created_by, 'imported by Overmind')
+        self.assertEquals(n.extra_data(), {'foo': 'bar'})
+        self.assertEquals(n.public_ip, '127.0.0.2')
+
+    def test_import_existing_nodes(self):
+        '''Should only update nodes that changed at the provider'''
+        self.p.import_nodes()
+        self.p.conn.conn.nl[0].state = NodeState.REBOOTING
+        result = self.p.import_nodes()
+        self.assertEquals(result['created'], 0)
+        self.assertEquals(result['updated'], 1)
+        self.assertEquals(result['skipped'], 2)
+        self.assertEquals(
+            Node.objects.get(provider=self.p, name='dummy-0').state, 'Rebooting')
+
+    def test_decommission_missing_nodes(self):
+        '''Should decommission nodes no longer listed by the provider'''
+        self.p.import_nodes()
+        self.p.conn.conn.nl.pop()
+        result = self.p.import_nodes()
+        self.assertEquals(result['decommissioned'], 1)
+        n = Node.objects.get(provider=self.p, node_id='2')
+        self.assertEquals(n.environment, 'Decommissioned')
+        self.assertEquals(n.name, 'DECOM1-dummy-2')
+
+    def test_duplicate_names(self):
+        '''Should import one of two provider nodes with the same name'''
+        self.p.create_connection()
+        self.p.conn.conn.nl[1].name = 'dummy-0'
+        result = self.p.import_nodes()
+        self.assertEquals(result['created'], 2)
+        self.assertEquals(sorted(Node.objects.filter(provider=self.p).values_list(
+            'name', flat=True)), ['dummy-0', 'dummy-2'])
+
+    def test_reused_name(self):
+        '''Should import a node that took the name of a removed one'''
+        self.p.import_nodes()
+        self.p.conn.conn.nl[0].id = 9
+        result = self.p.import_nodes()
+        self.assertEquals((result['created'], result['decommissioned']), (1, 1))
+        self.assertEquals(
+            Node.objects.get(provider=self.p, name='dummy-0').node_id, '9')
+
+    def test_skip_pending_names(self):
+        '''Should leave nodes being created to the create_node task'''
+        Node.objects.create(name='dummy-0', node_id='pending-1',
+            provider=self.p, state='Pending', created_by='test')
+        result = self.p.import_nodes()
+        self.assertEquals((result['created'], result['decommissioned']), (2, 0))
+        self.assertEquals(Node.objects.get(
+            provider=self.p, name='dummy-0').node_id, 'pending-1')
+
+
+class ImportNodesTransactionTest(TransactionTestCase):
+    def test_rollback_failed_sync(self):
+        '''Should not keep the decommissions of a sync that failed'''
+        p = Provider(name="prov1", provider_type="DUMMY", access_key="3")
+        p.save()
+        p.import_nodes()
+        p.conn.conn.nl.pop()
+        p.conn.conn.nl[0].state = NodeState.REBOOTING
+        def fail(nodes):
+            raise Exception('DB error')
+        original = models.sync_node_extra
+        models.sync_node_extra = fail
+        try:
+            self.assertRaises(Exception, p.import_nodes)
+        finally:
+            models.sync_node_extra = original
+        self.assertEquals(Node.objects.filter(
+            provider=p, environment='Decommissioned').count(), 0)
+
+
+class ImportCatalogTest(TestCase):
+    def setUp(self):
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="keyzz")
+        self.p.save()
+
+    def test_import_images(self):
+        '''Should only write new or changed images'''
+        result = self.p.import_images()
+        self.assertEquals(result, {'inserted': 3, 'updated': 0, 'unchanged': 0})
+        Image.objects.filter(provider=self.p, image_id='1').update(name='old')
+        # Forget the digest so that the catalog is compared row by row
+        CatalogState.objects.all().delete()
+        result = self.p.import_images()
+        self.assertEquals(result, {'inserted': 0, 'updated': 1, 'unchanged': 2})
+        self.assertEquals(
+            Image.objects.get(provider=self.p, image_id='1').name, 'Ubuntu 9.10')
+
+    def test_import_sizes(self):
+        '''Should leave sizes untouched when nothing changed'''
+        self.p.import_sizes()
+        count = Size.objects.filter(provider=self.p).count()
+        result = self.p.import_sizes(force=True)
+        self.assertEquals(result['inserted'] + result['updated'], 0)
+        self.assertEquals(result['unchanged'], count)
+
+    def test_skip_fresh_catalog(self):
+        '''Should not fetch a catalog again within the minimum interval'''
+        self.p.import_images()
+        self.assertEquals(self.p.import_images(), None)
+        CatalogState.objects.update(
+            checked_at=datetime.datetime.now() - datetime.timedelta(days=1))
+        result = self.p.import_images()
+        self.assertEquals(result, {'inserted': 0, 'updated': 0, 'unchanged': 3})
+
+
+class SyncIPsTest(TestCase):
+    def setUp(self):
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        self.p.save()
+        self.p.import_nodes()
+        self.n = Node.objects.get(provider=self.p)
+
+    def test_sync_ips(self):
+        '''Should add, move and remove IPs to match the given list'''
+        self.n.sync_ips(['10.0.0.1', '10.0.0.2'])
+        self.n.sync_ips(['10.0.0.2', '10.0.0.3'])
+        ips = [(ip.address, ip.position)
+            for ip in self.n.public_ips.order_by('position')]
+        self.assertEquals(ips, [('10.0.0.2', 0), ('10.0.0.3', 1)])
+        self.assertEquals(self.n.private_ips.count(), 0)
+
+    def test_sync_unchanged_ips(self):
+        '''Should not write anything when the IPs didn't change'''
+        self.n.sync_ips(['10.0.0.1', '10.0.0.2'])
+        self.assertNumQueries(1, self.n.sync_ips, ['10.0.0.1', '10.0.0.2'])
+
+    def test_primary_ips(self):
+        '''Should keep the primary public and private IPs up to date'''
+        self.n.sync_ips(['fe80::1', '10.0.0.1'])
+        self.n.sync_ips(['192.168.0.1'], public=False)
+        n = Node.objects.get(id=self.n.id)
+        self.assertEquals(n.public_ip, '10.0.0.1')
+        self.assertEquals(n.private_ip, '192.168.0.1')
+        # The provider is fetched once, the IP comes from the node row
+        n.provider
+        self.assertNumQueries(0, unicode, n)
+
+    def test_backfill_primary_ips(self):
+        '''Should set the primary IPs of existing nodes from their NodeIPs'''
+        self.n.sync_ips(['fe80::1', '10.0.0.1', '10.0.0.2'])
+        self.n.sync_ips(['192.168.0.2', '192.168.0.1'], public=False)
+        Node.objects.update(_public_ip='', _private_ip='')
+        call_command('sync_primary_ips', verbosity=0)
+        n = Node.objects.get(id=self.n.id)
+        self.assertEquals(n.public_ip, '10.0.0.1')
+        self.assertEquals(n.private_ip, '192.168.0.2')
+
+
+class DecommissionTest(TestCase):
+    def setUp(self):
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="3")
+        self.p.save()
+        self.p.import_nodes()
+
+    def test_decommission_recycled_name(self):
+        '''Should use the first free DECOMn- prefix'''
+        for name in ['DECOM1-dummy-0', 'DECOM2-dummy-0', 'DECOM4-dummy-0']:
+            Node.objects.create(
+                name=name, node_id=name, provider=self.p, created_by='test')
+        n = Node.objects.get(provider=self.p, name='dummy-0')
+        # One query for the taken names, two for save()
+        self.assertNumQueries(3, n.decommission)
+        self.assertEquals(n.name, 'DECOM3-dummy-0')
+        self.assertEquals(n.environment, 'Decommissioned')
+
+    def test_decommission_nodes(self):
+        '''Should decommission a set of nodes at once'''
+        nodes = list(Node.objects.filter(provider=self.p))
+        self.p.decommission_nodes(nodes)
+        names = Node.objects.filter(provider=self.p, environment='Decommissioned',
+            state='Terminated').values_list('name', flat=True)
+        self.assertEquals(sorted(names),
+            ['DECOM1-dummy-0', 'DECOM1-dummy-1', 'DECOM1-dummy-2'])
+
+
+class SupportsTest(TestCase):
+    def test_supports(self):
+        '''Should only query the supported actions once'''
+        p = Provider(name="prov1", provider_type="dedicated")
+        p.save()
+        self.assertTrue(p.supports('create'))
+        self.assertNumQueries(0, p.supports, 'list')
+        self.assertFalse(p.supports('list'))
+        self.assertFalse(Provider.objects.get(id=p.id).supports('list'))
+
+
+class PluginsTest(TestCase):
+    def test_load_plugins(self):
+        '''Should read the plugin metadata without importing the plugin'''
+        meta = plugins.load_plugins()['hetzner']
+        self.assertEquals(meta['display_name'], hetzner.display_name)
+        self.assertEquals(meta['supported_actions'], hetzner.supported_actions)
+        self.assertEquals(plugins.load_plugins()['dedicated']['rate_limit'], None)
+        self.assertTrue(plugins.get_driver('hetzner') is hetzner.Driver)
+
+
+class ConnectionCacheTest(TestCase):
+    def test_reuse_connection(self):
+        '''Should reuse the driver of a provider until its credentials change'''
+        p = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        p.save()
+        p1 = Provider.objects.get(id=p.id)
+        p1.create_connection()
+        p2 = Provider.objects.get(id=p.id)
+        p2.create_connection()
+        self.assertTrue(p1.conn.conn is p2.conn.conn)
+        p2.access_key = "2"
+        p2.conn = None
+        p2.create_connection()
+        self.assertFalse(p1.conn.conn is p2.conn.conn)
+
+    def test_connection_per_thread(self):
+        '''Should not share a driver between threads'''
+        p = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        p.save()
+        conns = []
+        def connect():
+            conns.append(get_connection(p))
+        connect()
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join()
+        self.assertTrue(get_connection(p) is conns[0])
+        self.assertFalse(conns[0] is conns[1])
+
+
+class IndexesTest(TestCase):
+    def test_hot_queries_use_indexes(self):
+        '''Should not do a full table scan for any hot query'''
+        call_command('check_indexes', verbosity=0)
+
+
+class StartupProfileTest(TestCase):
+    def test_startup_profile(self):
+        '''Should profile the imports in a new interpreter'''
+        out = StringIO()
+        call_command('startup_profile', 'provisioning.bulk', limit=5, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEquals(lines[0].split(), ['total', 'ms', 'own', 'ms', 'module'])
+        # The header, the 5 slowest modules and the total
+        self.assertEquals(len(lines), 7)
+        self.assertTrue(lines[-1].startswith('Imported '))
+
+
+class SyncScheduleTest(TestCase):
+    def setUp(self):
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        self.p.save()
+
+    def test_sync_in_flight(self):
+        '''Should not start a sync while the previous one is running'''
+        self.assertTrue(self.p.sync_due())
+        self.p.start_sync()
+        self.assertFalse(Provider.objects.get(id=self.p.id).sync_due())
+        self.p.finish_sync(1)
+        p = Provider.objects.get(id=self.p.id)
+        self.assertFalse(p.sync_in_flight())
+        self.assertFalse(p.sync_due())
+        self.assertTrue(p.sync_due(p.next_sync_at))
+
+    def test_backoff_without_changes(self):
+        '''Should sync less often while nothing changes'''
+        self.p.start_sync()
+        self.p.finish_sync(0)
+        self.assertEquals(self.p.sync_interval, 60)
+        self.p.start_sync()
+        self.p.finish_sync(0)
+        self.assertEquals(self.p.sync_interval, 120)
+        self.p.start_sync()
+        self.p.finish_sync(3)
+        self.assertEquals(self.p.sync_interval, 30)
+
+
+class SyncLeaseTest(TestCase):
+    def setUp(self):
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        self.p.save()
+
+    def test_skip_running_sync(self):
+        '''Should skip a sync while another one holds the lease'''
+        self.assertTrue(SyncLease.acquire(self.p, 'nodes', 'other'))
+        self.assertEquals(self.p.import_nodes(), None)
+        self.assertEquals(Node.objects.count(), 0)
+        SyncLease.release(self.p, 'nodes', 'other')
+        self.assertEquals(self.p.import_nodes()['created'], 1)
+        self.assertEquals(SyncLease.objects.count(), 0)
+
+    def test_skipped_sync_not_recorded(self):
+        '''Should leave the running sync in flight when a sync is skipped'''
+        self.p.start_sync()
+        self.assertTrue(SyncLease.acquire(self.p, 'nodes', 'other'))
+        tasks.import_nodes(self.p.id)
+        p = Provider.objects.get(id=self.p.id)
+        self.assertTrue(p.sync_in_flight())
+        self.assertEquals(p.sync_interval, self.p.sync_interval)
+        self.assertEquals(SyncRun.objects.count(), 0)
+
+    def test_take_over_expired_lease(self):
+        '''Should take over a lease that expired'''
+        self.assertTrue(SyncLease.acquire(self.p, 'nodes', 'lost', timeout=-1))
+        self.assertTrue(SyncLease.acquire(self.p, 'images', 'a'))
+        self.assertFalse(SyncLease.acquire(self.p, 'images', 'b'))
+        self.assertTrue(SyncLease.acquire(self.p, 'nodes', 'new'))
+        self.assertEquals(
+            SyncLease.objects.get(provider=self.p, kind='nodes').owner, 'new')
+
+
+class SyncRunTest(TestCase):
+    def setUp(self):
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="3")
+        self.p.save()
+
+    def test_record_import(self):
+        '''Should record the timings and counts of every import'''
+        tasks.import_nodes(self.p.id)
+        tasks.import_sizes(self.p.id)
+        run = SyncRun.objects.get(provider=self.p, kind='nodes')
+        self.assertEquals((run.created, run.updated, run.deleted), (3, 0, 0))
+        self.assertAlmostEquals(run.duration, run.api_time + run.db_time)
+        self.assertEquals(run.error, '')
+        run = SyncRun.objects.get(provider=self.p, kind='sizes')
+        self.assertTrue(run.created > 0)
+
+    def test_record_non_ascii_error(self):
+        '''Should record errors with non-ASCII bytes'''
+        run = SyncRun.record(self.p, 'nodes', datetime.datetime.now(), 1.0,
+            0.5, error=Exception('<h1>Wartungsarbeiten \xc3\xbcber Nacht</h1>'))
+        self.assertEquals(run.error, u'<h1>Wartungsarbeiten \xfcber Nacht</h1>')
+
+    def test_prune(self):
+        '''Should delete the runs older than the retention period'''
+        now = datetime.datetime.now()
+        for days in [1, 20, 30]:
+            SyncRun.record(self.p, 'nodes', now - datetime.timedelta(days=days),
+                1.0, 0.5)
+        self.assertEquals(SyncRun.prune(), 2)
+        self.assertEquals(SyncRun.objects.count(), 1)
+
+    def test_percentile(self):
+        '''Should return the nearest-rank percentile'''
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 50)
+        self.assertEquals(percentile(values, 99), 99)
+        self.assertEquals(percentile([3], 90), 3)
+        self.assertEquals(percentile([], 90), None)
+
+
+class ImportProviderInfoTest(TestCase):
+    def setUp(self):
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="3")
+        self.p.save()
+
+    def test_import_catalog_then_nodes(self):
+        '''Should import the catalog, then the nodes, and mark the provider
+        as ready'''
+        tasks.import_provider_info(self.p.id)
+        self.assertTrue(Provider.objects.get(id=self.p.id).ready)
+        self.assertTrue(Image.objects.filter(provider=self.p).count() > 0)
+        self.assertTrue(Location.objects.filter(provider=self.p).count() > 0)
+        self.assertTrue(Size.objects.filter(provider=self.p).count() > 0)
+        self.assertEquals(Node.objects.filter(provider=self.p).count(), 3)
+        kinds = [r.kind for r in
+            SyncRun.objects.filter(provider=self.p).order_by('id')]
+        self.assertEquals(sorted(kinds[:3]), ['images', 'locations', 'sizes'])
+        self.assertEquals(kinds[3:], ['nodes'])
+
+    def test_failed_stage(self):
+        '''Should still import the nodes when a catalog import fails'''
+        def fail(self, **kwargs):
+            raise Exception('API down')
+        original = Provider.import_images
+        Provider.import_images = fail
+        try:
+            tasks.import_provider_info(self.p.id)
+        finally:
+            Provider.import_images = original
+        self.assertTrue(Provider.objects.get(id=self.p.id).ready)
+        self.assertEquals(Node.objects.filter(provider=self.p).count(), 3)
+        self.assertEquals(
+            SyncRun.objects.get(provider=self.p, kind='images').error, 'API down')
+
+    def test_chord(self):
+        '''Should import the catalog in a chord outside of eager mode'''
+        calls = []
+        def chord(header):
+            return lambda callback: calls.append((header, callback))
+        original_chord, eager = tasks.chord, settings.CELERY_ALWAYS_EAGER
+        tasks.chord, settings.CELERY_ALWAYS_EAGER = chord, False
+        try:
+            tasks.import_provider_info(self.p.id)
+        finally:
+            tasks.chord, settings.CELERY_ALWAYS_EAGER = original_chord, eager
+        header, callback = calls[0]
+        self.assertEquals([(s.task, s.args) for s in header], [
+            ('provisioning.tasks.import_catalog', (self.p.id, kind))
+            for kind in ['images', 'locations', 'sizes']])
+        self.assertEquals((callback.task, callback.args),
+            ('provisioning.tasks.import_catalog_done', (self.p.id,)))
+
+    def test_catalog_done(self):
+        '''Should import the nodes after the catalog, even if a stage
+        failed'''
+        results = [Exception('API down'),
+            {'kind': 'sizes', 'duration': 0.1, 'result': None}]
+        tasks.import_catalog_done(results, self.p.id)
+        self.assertTrue(Provider.objects.get(id=self.p.id).ready)
+        self.assertEquals(Node.objects.filter(provider=self.p).count(), 3)
+
+
+class OverviewTest(TestCase):
+    urls = 'overmind.test_urls'
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'a@a.com', 'pass')
+        self.assertTrue(self.client.login(username='admin', password='pass'))
+
+    def add_nodes(self, name, count):
+        p = Provider(name=name, provider_type="DUMMY", access_key=str(count))
+        p.save()
+        for kind in ['images', 'locations', 'sizes']:
+            getattr(p, 'import_' + kind)()
+        p.import_nodes()
+        Node.objects.filter(provider=p).update(
+            image=Image.objects.filter(provider=p)[0],
+            location=Location.objects.filter(provider=p)[0],
+            size=Size.objects.filter(provider=p)[0])
+
+    def count_queries(self, path):
+        # The queries log is emptied when a request starts
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get(path)
+        finally:
+            connection.use_debug_cursor = False
+        self.assertEquals(response.status_code, 200)
+        return len(connection.queries), response
+
+    def test_query_budget(self):
+        '''Should not run more queries when there are more nodes'''
+        self.add_nodes('prov1', 2)
+        queries, response = self.count_queries('/overview/')
+        self.assertContains(response, 'dummy-1 - 127.0.0.2 - Running')
+        self.assertContains(response, '/node/%s/reboot' %
+            Node.objects.get(name='dummy-1').id)
+        self.add_nodes('prov2', 10)
+        self.assertEquals(self.count_queries('/overview/')[0], queries)
+        # Session, user, provider actions, nodes and the provider list
+        self.assertEquals(queries, 5)
+
+    def test_pending_node_actions(self):
+        '''Should not show actions for nodes being created'''
+        self.add_nodes('prov1', 1)
+        n = Node.objects.get(name='dummy-0')
+        Node.objects.filter(id=n.id).update(node_id='pending-1', state='Pending')
+        response = self.client.get('/overview/')
+        self.assertNotContains(response, '/node/%s/reboot' % n.id)
+        self.assertNotContains(response, '/node/%s/destroy' % n.id)
+
+    def test_node_detail(self):
+        '''Should serve the node details on demand instead of inline'''
+        self.add_nodes('prov1', 1)
+        n = Node.objects.get(name='dummy-0')
+        response = self.client.get('/overview/')
+        self.assertNotContains(response, '<table>')
+        self.assertContains(response, 'data-node="%s"' % n.id)
+
+        response = self.client.get('/node/%s/detail/' % n.id)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/json')
+        fields = dict(json.loads(response.content)['fields'])
+        self.assertEquals(fields['Node ID'], n.node_id)
+        self.assertEquals(fields['foo'], 'bar')
+
+
+class CreateNodeTaskTest(TestCase):
+    def setUp(self):
+        self.p = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        self.p.save()
+        for kind in ['images', 'locations', 'sizes']:
+            getattr(self.p, 'import_' + kind)()
+        self.n = Node.objects.create(name='newnode', node_id='pending-1',
+            provider=self.p, state='Begin', created_by='test')
+        image = Image.objects.filter(provider=self.p)[0]
+        image.favorite = True
+        image.save()
+        self.data = {
+            'provider': self.p.id,
+            'name': 'newnode',
+            'image': image.id,
+            'location': Location.objects.filter(provider=self.p)[0].id,
+            'size': Size.objects.filter(provider=self.p)[0].id,
+        }
+
+    def test_create_node_exception(self):
+        '''Should decommission the node and keep the error when creating it
+        raises'''
+        def create_node(self, form):
+            raise RateLimitExceeded('No provider API requests left')
+        original = Provider.create_node
+        Provider.create_node = create_node
+        try:
+            tasks.create_node(self.n.id, self.data)
+        finally:
+            Provider.create_node = original
+        n = Node.objects.get(id=self.n.id)
+        self.assertEquals(n.environment, 'Decommissioned')
+        self.assertEquals(
+            n.extra_data(), {'error': 'No provider API requests left'})
+
+    def test_save_exception(self):
+        '''Should keep the node when saving it fails after it was created'''
+        def sync_ips(self, ips, public=True):
+            raise Exception('DB error')
+        original = Node.sync_ips
+        Node.sync_ips = sync_ips
+        try:
+            tasks.create_node(self.n.id, self.data)
+        finally:
+            Node.sync_ips = original
+        n = Node.objects.get(id=self.n.id)
+        self.assertEquals(n.environment, 'Production')
+        self.assertFalse(n.pending)
+
+    def test_deleted_node(self):
+        '''Should do nothing when the node was deleted'''
+        self.n.delete()
+        tasks.create_node(self.n.id, self.data)
+
+
+class NodeActionTest(TestCase):
+    def test_reboot_nodes(self):
+        '''Should reboot all nodes and report missing ones'''
+        p = Provider(name="prov1", provider_type="DUMMY", access_key="3")
+        p.save()
+        p.import_nodes()
+        ids = list(Node.objects.values_list('id', flat=True))
+        results = tasks.node_action('reboot', ids + [9999], 'testuser')
+        for node_id in ids:
+            self.assertEquals(
+                results[str(node_id)], {'result': True, 'error': None})
+        self.assertEquals(results['9999'],
+            {'result': False, 'error': 'Node not found'})
+
+    def test_destroy_nodes(self):
+        '''Should decommission destroyed nodes'''
+        p = Provider(name="prov1", provider_type="dedicated")
+        p.save()
+        for name in ['n1', 'n2']:
+            Node.objects.create(
+                name=name, node_id=name, provider=p, created_by='test')
+        ids = list(Node.objects.values_list('id', flat=True))
+        tasks.node_action('destroy', ids, 'testuser')
+        self.assertEquals(Node.objects.filter(environment='Decommissioned',
+            destroyed_by='testuser').count(), 2)
+
+    def test_skip_pending_nodes(self):
+        '''Should not act on nodes that are still being created'''
+        p = Provider(name="prov1", provider_type="dedicated")
+        p.save()
+        n = Node.objects.create(name='n1', node_id='pending-1', provider=p,
+            state='Pending', created_by='test')
+        results = tasks.node_action('destroy', [n.id], 'testuser')
+        self.assertEquals(results[str(n.id)],
+            {'result': False, 'error': 'Node is still being created'})
+        self.assertEquals(Node.objects.get(id=n.id).environment, 'Production')
+
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_burst(self):
+        '''Should allow a burst of calls, then make callers wait'''
+        bucket = TokenBucket('account', 0.01, 4, self.dir)
+        for i in range(4):
+            bucket.acquire(timeout=0)
+        self.assertRaises(RateLimitExceeded, bucket.acquire, timeout=0)
+        # Buckets are shared through the directory
+        other = TokenBucket('account', 0.01, 4, self.dir)
+        self.assertRaises(RateLimitExceeded, other.acquire, timeout=0)
+
+    def test_sync_yields_to_users(self):
+        '''Should keep part of the burst for user actions'''
+        bucket = TokenBucket('account', 0.01, 4, self.dir)
+        for i in range(3):
+            bucket.acquire(PRIORITY_SYNC, timeout=0)
+        self.assertRaises(
+            RateLimitExceeded, bucket.acquire, PRIORITY_SYNC, timeout=0)
+        bucket.acquire(PRIORITY_USER, timeout=0)
+
+    def test_interactive_timeout(self):
+        '''Should give up at once on user actions that would wait long'''
+        p = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        p.save()
+        p.import_nodes()
+        n = Node.objects.get(provider=p)
+        p.conn.bucket = TokenBucket('account', 0.01, 1, self.dir)
+        p.conn.bucket.acquire(timeout=0)
+        start = time.time()
+        self.assertRaises(RateLimitExceeded, p.conn.reboot_node, n)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_create_node_rate_limited(self):
+        '''Should return a rate limit timeout as the creation error'''
+        class Form(object):
+            cleaned_data = {'name': 'newnode'}
+        class EmptyBucket(object):
+            def acquire(self, priority, timeout=None):
+                raise RateLimitExceeded('No provider API requests left')
+        p = Provider(name="prov1", provider_type="DUMMY", access_key="1")
+        p.save()
+        p.conn.bucket = EmptyBucket()
+        error, data = p.conn.create_node(Form())
+        self.assertTrue(isinstance(error, RateLimitExceeded))
+        self.assertEquals(data, None)
+
+
+class ProbeTest(TestCase):
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_probe(self):
+        '''Should tell which addresses accept connections'''
+        up = probe(['127.0.0.1', '127.0.0.2'], [self.port], concurrency=1)
+        self.assertEquals(up, {'127.0.0.1': True, '127.0.0.2': False})
+
+    def test_unsupported_family(self):
+        '''Should report addresses of families the host lacks as down'''
+        original = socket.socket
+        def no_ipv6(family, *args):
+            if family == socket.AF_INET6:
+                raise socket.error('Address family not supported by protocol')
+            return original(family, *args)
+        socket.socket = no_ipv6
+        try:
+            up = probe(['127.0.0.1', '::1'], [self.port])
+        finally:
+            socket.socket = original
+        self.assertEquals(up, {'127.0.0.1': True, '::1': False})
+
+    def test_probe_nodes(self):
+        '''Should update the state of the nodes that changed'''
+        p = Provider(name="prov1", provider_type="dedicated")
+        p.save()
+        for name, ip, state in [('n1', '127.0.0.1', 'Unknown'),
+                ('n2', '127.0.0.2', 'Running'), ('n3', '127.0.0.1', 'Running')]:
+            n = Node.objects.create(name=name, node_id=name, provider=p,
+                state=state, created_by='test')
+            n.sync_ips([ip])
+        result = p.probe_nodes([self.port])
+        self.assertEquals(result, {'up': 1, 'down': 1, 'updated': 2})
+        states = dict(Node.objects.values_list('name', 'state'))
+        self.assertEquals(states,
+            {'n1': 'Running', 'n2': 'Unknown', 'n3': 'Running'})
+
+
+class FakeHetznerHttp(object):
+    '''Answers robot-ws requests for a list of server IPs'''
+    def __init__(self, ips):
+        self.ips = ips
+        self.requests = []
+
+    def request(self, uri, method, body):
+        path = uri[len(hetzner.Connection.host):]
+        self.requests.append(path)
+        if path == 'server':
+            content = [{'server': {'server_ip': ip, 'status': 'ready'}}
+                for ip in self.ips]
+        elif path.startswith('reset/'):
+            content = {}
+        else:
+            ip = path.split('/')[1]
+            content = {'server': {'ip': [ip], 'subnet': None}}
+        return {'status': '200'}, json.dumps(content)
+
+
+class HetznerTest(TestCase):
+    def setUp(self):
+        self.driver = hetzner.Driver('user', 'password')
+        self.http = FakeHetznerHttp(['10.0.0.%s' % i for i in range(20)])
+        self.driver.connection._get_http = lambda: self.http
+
+    def test_list_nodes(self):
+        '''Should list the servers in order with their details'''
+        nodes = self.driver.list_nodes()
+        self.assertEquals([n.name for n in nodes],
+            ['10.0.0.%s' % i for i in range(20)])
+        self.assertEquals(nodes[3].public_ips, ['10.0.0.3'])
+        self.assertEquals(nodes[3].state, NodeState.RUNNING)
+        self.assertEquals(nodes[3].extra['extra_ips'], '10.0.0.3')
+
+    def test_cache_details(self):
+        '''Should only fetch the details of new or changed servers'''
+        self.driver.list_nodes()
+        self.http.requests = []
+        self.http.ips.append('10.0.0.99')
+        # The server list is cached too
+        self.driver.connection.cache.invalidate('server')
+        self.driver.list_nodes()
+        self.assertEquals(self.http.requests, ['server', 'server/10.0.0.99'])
+        self.assertEquals(self.driver.connection.cache.hits, 20)
+
+    def test_cache_bounds(self):
+        '''Should evict the least recently used responses'''
+        cache = hetzner.ResponseCache(max_entries=2)
+        cache.set('server/1', '1')
+        cache.set('server/2', '2')
+        cache.get('server/1')
+        cache.set('server/3', '3')
+        self.assertEquals(cache.get('server/2'), None)
+        self.assertEquals(cache.get('server/1'), '1')
+        # Paths without a TTL aren't cached
+        cache.set('reset/1/', '{}')
+        self.assertEquals(cache.get('reset/1/'), None)
+        self.assertEquals((cache.hits, cache.misses), (2, 2))
+        cache.invalidate('server/1')
+        cache.set('server/4', '4')
+        self.assertEquals(cache.get('server/3'), '3')
+        self.assertEquals(cache.get('server/4'), '4')
+
+    def test_bypass_mutating_calls(self):
+        '''Should not cache POST requests and drop cached responses'''
+        conn = self.driver.connection
+        conn.request('server')
+        conn.request('reset/10.0.0.1/', method='POST', params={'type': 'sw'})
+        conn.request('reset/10.0.0.1/', method='POST', params={'type': 'sw'})
+        conn.request('server')
+        self.assertEquals(self.http.requests, ['server',
+            'reset/10.0.0.1/', 'reset/10.0.0.1/', 'server'])
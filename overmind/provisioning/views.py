@@ -1,58 +1,42 @@
 import logging
 import json
+import uuid
 
 from django.shortcuts import render_to_response, get_object_or_404
 from django.http import HttpResponse, HttpResponseRedirect
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.decorators import login_required, permission_required
+from django.views.decorators.cache import cache_control
 from django.template import RequestContext
-from libcloud.common.types import InvalidCredsException
 
-from provisioning.models import Action, Provider, Node, get_state, Image
+from provisioning.models import Action, Provider, Node, Image
 from provisioning import tasks
 from provisioning.forms import ProviderForm, NodeForm, AddImageForm, ProfileEditForm
 from provisioning.forms import UserCreationFormExtended, UserEditForm
 from provisioning.provider_meta import PROVIDERS
+from provisioning.ratelimit import RateLimitExceeded
 
 
 @login_required
 def overview(request):
     provider_list = Provider.objects.all()
-    nodes = []
-    #TODO: Optimize for hundreds of nodes
-    for n in Node.objects.exclude(environment='Decommissioned'):
-        datatable = "<table>"
-        fields = [
-            ['Created by', n.created_by],
-            ['Created at', n.created_at.strftime('%Y-%m-%d %H:%M:%S')],
-            ['Node ID', n.node_id],
-            ['OS image', n.image or "-"],
-            ['Location', n.location or "-"],
-            ['Size', n.size or "-"],
-        ]
-        if n.size and n.size.price:
-            fields.append(['Price', n.size.price + ' $/hour'])
-        fields.append(['-----', '-----'])
-        if n.destroyed_by:
-            fields.append(['Destroyed by', n.destroyed_by])
-            fields.append(['Destroyed at', n.destroyed_at])
-        if n.private_ip:
-            fields.append(['private_ip', n.private_ip])
-
-        for key, val in n.extra_data().items():
-            fields.append([key, val])
-
-        for field in fields:
-            datatable += "<tr><td>" + field[0] + ":</td><td>" + str(field[1])
-            datatable += "</td></tr></td>"
-        datatable += "</table>"
+    # Shown actions of every provider, with one query for all of them
+    provider_actions = {}
+    for provider_id, name in Provider.actions.through.objects.filter(
+            action__show=True).values_list('provider', 'action__name'):
+        provider_actions.setdefault(provider_id, set()).add(name)
+    can_change = request.user.has_perm('provisioning.change_node')
 
+    nodes = []
+    # The tooltip details of a node are loaded on demand from nodedetail
+    for n in Node.objects.filter(environment__in=Node.ACTIVE_ENVIRONMENTS
+            ).select_related('provider'):
         actions_list = []
-        if n.state != 'Terminated' and \
-            request.user.has_perm('provisioning.change_node'):
-            actions = n.provider.actions.filter(show=True)
+        # Nodes being created can't be acted on until they have their id
+        if n.state != 'Terminated' and can_change and not n.pending:
+            actions = provider_actions.get(n.provider_id, ())
 
-            if actions.filter(name='reboot'):
+            if 'reboot' in actions:
                 actions_list.append({
                     'action': 'reboot',
                     'label': 'reboot',
@@ -60,7 +44,7 @@ def overview(request):
                     % n.name,
                 })
 
-            if actions.filter(name='destroy'):
+            if 'destroy' in actions:
                 actions_list.append({
                     'action': 'destroy',
                     'label': 'destroy',
@@ -74,7 +58,7 @@ def overview(request):
                     'confirmation': 'This action will remove the node %s with IP %s' % (n.name, n.public_ip),
                 })
 
-        nodes.append({ 'node': n, 'data': datatable, 'actions': actions_list })
+        nodes.append({ 'node': n, 'actions': actions_list })
 
     variables = RequestContext(request, {
         'nodes': nodes,
@@ -118,6 +102,7 @@ def update_provider(data, provider):
     return save_provider(form)
 
 def save_provider(form):
+    from libcloud.common.types import InvalidCredsException
     error = None
     if form.is_valid():
         provider = None
@@ -212,6 +197,9 @@ def newnode(request):
         { 'form': form, 'favcount': favcount, 'error': error })
 
 def save_new_node(data, user):
+    '''Validates data and saves a new node in the "Begin" state
+    The node is created at the provider by the create_node task
+    '''
     provider_id = data.get("provider")
     if not provider_id:
         return 'Incorrect provider id', None, None
@@ -231,25 +219,22 @@ def save_new_node(data, user):
                 )
                 error = 'A node with that name already exists'
             except Node.DoesNotExist:
-                error, data_from_provider = provider.create_node(form)
-                if error is None:
-                    node = form.save(commit = False)
-                    node.node_id    = str(data_from_provider['node_id'])
-                    node.public_ip  = data_from_provider['public_ip']
-                    node.private_ip = data_from_provider.get('private_ip', '')
-                    node.state      = get_state(data_from_provider['state'])
-                    node.created_by = user.username
-                    node.save_extra_data(data_from_provider.get('extra', ''))
-                    try:
-                        node.save()
-                        logging.info('New node created %s' % node)
-                        # Mark image as recently used by saving it
-                        if node.image is not None:
-                            node.image.save()
-                        return None, form, node
-                    except Exception, e:
-                        error = e
-                        logging.error('Could not create node: %s' % e)
+                node = form.save(commit = False)
+                # Placeholder until the provider assigns the real id
+                node.node_id    = 'pending-' + uuid.uuid4().hex
+                node.state      = 'Begin'
+                node.created_by = user.username
+                try:
+                    node.save()
+                    logging.info('New node saved %s' % node)
+                    # Mark image as recently used by saving it
+                    if node.image is not None:
+                        node.image.save()
+                    tasks.create_node.delay(node.id, dict(data.items()))
+                    return None, form, node
+                except Exception, e:
+                    error = e
+                    logging.error('Could not create node: %s' % e)
         else:
             error = 'form'
     return error, form, None
@@ -257,15 +242,53 @@ def save_new_node(data, user):
 @permission_required('provisioning.change_node')
 def rebootnode(request, node_id):
     node = Node.objects.get(id=node_id)
-    result = node.reboot()
+    if not node.pending:
+        try:
+            node.reboot()
+        except RateLimitExceeded, e:
+            return HttpResponse(str(e), status=503)
     return HttpResponseRedirect('/overview/')
 
 @permission_required('provisioning.delete_node')
 def destroynode(request, node_id):
     node = Node.objects.get(id=node_id)
-    result = node.destroy(request.user.username)
+    if not node.pending:
+        try:
+            node.destroy(request.user.username)
+        except RateLimitExceeded, e:
+            return HttpResponse(str(e), status=503)
     return HttpResponseRedirect('/overview/')
 
+@login_required
+@cache_control(private=True, max_age=60)
+def nodedetail(request, node_id):
+    '''Returns the tooltip details of a node as JSON'''
+    n = get_object_or_404(
+        Node.objects.select_related('image', 'location', 'size'), id=node_id)
+    fields = [
+        ['Created by', n.created_by],
+        ['Created at', n.created_at.strftime('%Y-%m-%d %H:%M:%S')],
+        ['Node ID', n.node_id],
+        ['OS image', n.image or "-"],
+        ['Location', n.location or "-"],
+        ['Size', n.size or "-"],
+    ]
+    if n.size and n.size.price:
+        fields.append(['Price', n.size.price + ' $/hour'])
+    fields.append(['-----', '-----'])
+    if n.destroyed_by:
+        fields.append(['Destroyed by', n.destroyed_by])
+        fields.append(['Destroyed at', n.destroyed_at])
+    if n.private_ip:
+        fields.append(['private_ip', n.private_ip])
+
+    for key, val in n.extra_data().items():
+        fields.append([key, val])
+    return HttpResponse(json.dumps({
+        'id': n.id,
+        'fields': [[label, unicode(value)] for label, value in fields],
+    }), mimetype='application/json')
+
 @login_required
 def settings(request):
     variables = RequestContext(request, {
@@ -92,8 +92,26 @@ INSTALLED_APPS = (
     'api',
 )
 
+# Public key deployed to new nodes, read from ~/.ssh/ when a node is created.
+# Set PUBLIC_KEY to give the key itself instead
 PUBLIC_KEY_FILE = "id_rsa.pub"
-PUBLIC_KEY = open(os.path.expanduser("~/.ssh/%s" % PUBLIC_KEY_FILE)).read()
+#PUBLIC_KEY = "ssh-rsa AAAA..."
+
+# Provider API rate limits as (requests per second, burst) per provider type,
+# overriding the defaults in provisioning/provider_meta.py. None disables it
+#PROVIDER_RATE_LIMITS = {
+#    'EC2_US_EAST': (2.0, 10),
+#}
+# Directory where worker processes share the rate limit state
+#RATE_LIMIT_DIR = '/var/run/overmind/ratelimit'
+
+# Seconds before provider images, locations and sizes are fetched again
+#CATALOG_MIN_INTERVAL = 3600
+
+# Liveness probing of nodes of providers that can't list them (dedicated)
+#PROBE_PORTS = [22]
+#PROBE_TIMEOUT = 3
+#PROBE_CONCURRENCY = 256
 
 # Configure logging
 if DEBUG:
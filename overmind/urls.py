@@ -20,6 +20,7 @@ urlpatterns += patterns('',
     (r'^provider/$', 'provisioning.views.provider'),
     (r'^node/$', 'provisioning.views.node'),
     (r'^settings/$', 'provisioning.views.settings'),
+    (r'^node/(?P<node_id>\d+)/detail/$', 'provisioning.views.nodedetail'),
     
     # Create
     (r'^provider/new/$', 'provisioning.views.newprovider'),